@@ -0,0 +1,194 @@
+import ipaddress
+
+import yaml
+
+
+_ACTIONS = ('allow', 'deny')
+
+
+
+class _Node(object):
+    __slots__ = ('slots', 'children', 'rules')
+
+    def __init__(self):
+        self.slots = {}         # key -> [(prefix length, deny, ports), ...], longest first
+        self.children = {}      # key -> _Node
+        self.rules = []         # rules matching every key below this node, e.g. 0.0.0.0/0 or *.example.com
+
+
+def _add(entries, length, deny, ports):
+    entries.append((length, deny, ports))
+    # longest prefix first, deny before allow on the same prefix
+    entries.sort(key=lambda e: (-e[0], not e[1]))
+
+
+def _match(entries, port):
+    for length, deny, ports in entries:
+        if ports is None or port in ports: return length, deny
+    return None
+
+
+
+class _AddressTrie(object):
+    """Multibit trie with 8 bit strides, prefixes which end inside a byte are expanded over its slots"""
+
+    def __init__(self): self.__root = _Node()
+
+    def add(self, network, deny, ports):
+        data, length = network.network_address.packed, network.prefixlen
+        if length == 0:
+            _add(self.__root.rules, 0, deny, ports)
+            return
+
+        node, last = self.__root, (length - 1) // 8
+        for b in data[:last]:
+            node = node.children.setdefault(b, _Node())
+
+        bits = length - last * 8
+        base = data[last] & (0xff << (8 - bits)) & 0xff
+        for b in range(base, base + (1 << (8 - bits))):
+            _add(node.slots.setdefault(b, []), length, deny, ports)
+
+    def lookup(self, data, port):
+        node, best = self.__root, _match(self.__root.rules, port)
+        for b in data:
+            entries = node.slots.get(b, None)
+            if entries:
+                m = _match(entries, port)
+                if m is not None and (best is None or m[0] > best[0]): best = m
+            node = node.children.get(b, None)
+            if node is None: break
+        return best
+
+
+
+class _HostTrie(object):
+    """Trie of reversed host name labels, '*.example.com' matches every name below example.com"""
+
+    def __init__(self): self.__root = _Node()
+
+    def add(self, pattern, deny, ports):
+        labels = pattern.lower().rstrip('.').split('.')[::-1]
+        wildcard = labels[-1] == '*'
+        if wildcard: labels = labels[:-1]
+
+        node = self.__root
+        for label in labels: node = node.children.setdefault(label, _Node())
+        if wildcard: _add(node.rules, len(labels), deny, ports)
+        else: _add(node.slots.setdefault(None, []), len(labels) + 1, deny, ports)
+
+    def lookup(self, labels, port):
+        node, best = self.__root, None
+        for label in labels:
+            if node.rules:
+                m = _match(node.rules, port)
+                if m is not None: best = m
+            node = node.children.get(label, None)
+            if node is None: return best
+
+        m = _match(node.slots.get(None, ()), port)
+        return m if m is not None else best
+
+
+
+class _Targets(object):
+    def __init__(self):
+        self.v4 = _AddressTrie()
+        self.v6 = _AddressTrie()
+        self.hosts = _HostTrie()
+
+    def add(self, target, deny, ports):
+        try:
+            network = ipaddress.ip_network(target, strict=False)
+        except ValueError:
+            self.hosts.add(target, deny, ports)
+            return
+        (self.v4 if network.version == 4 else self.v6).add(network, deny, ports)
+
+
+def _key(host):
+    """Return the trie of _Targets and the lookup data of host"""
+    try:
+        address = ipaddress.ip_address(host)
+        return 'v4' if address.version == 4 else 'v6', address.packed
+    except ValueError:
+        return 'hosts', host.lower().rstrip('.').split('.')[::-1]
+
+
+
+class AclPolicy(object):
+    """
+    Destination ACL of users and groups compiled into tries.
+
+    The policy is a yaml file:
+
+        default: deny
+        groups:
+          ops: [alice, bob]
+        rules:
+          - {subjects: ['@ops'], allow: ['10.0.0.0/8', '*.db.example.com'], ports: [22]}
+          - {subjects: [alice], deny: ['10.1.2.0/24']}
+          - {subjects: ['*'], allow: ['192.168.0.0/16']}
+
+    The rules of the user are looked up first, then those of its groups and then those of '*'. The
+    first of them with a matching rule decides: its longest prefix or most specific host pattern
+    wins, deny before allow. IP literals only match networks and host names only match host
+    patterns, host names are not resolved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, encoding='utf-8') as f:
+            policy = yaml.safe_load(f) or {}
+
+        default = policy.get('default', 'deny')
+        if default not in _ACTIONS: raise ValueError('Invalid acl default {}'.format(default))
+        self.__default = default == 'allow'
+
+        self.__groups = {}          # user -> ('@group', ...)
+        for group, users in (policy.get('groups', None) or {}).items():
+            for user in users: self.__groups[user] = self.__groups.get(user, ()) + ('@' + group,)
+
+        self.__subjects = {}        # user, '@group' or '*' -> _Targets
+        for rule in policy.get('rules', None) or ():
+            ports = rule.get('ports', None)
+            ports = None if ports is None else frozenset(int(p) for p in ports)
+            for subject in rule['subjects']:
+                targets = self.__subjects.setdefault(subject, _Targets())
+                for action in _ACTIONS:
+                    for target in rule.get(action, None) or (): targets.add(str(target), action == 'deny', ports)
+
+
+    def check(self, username, host, port):
+        """Return whether username may connect to host:port"""
+        key, data = _key(host)
+        for subject in (username,) + self.__groups.get(username, ()) + ('*',):
+            targets = self.__subjects.get(subject, None)
+            if targets is None: continue
+            m = getattr(targets, key).lookup(data, port)
+            if m is not None: return not m[1]
+
+        return self.__default
+
+
+
+class ModePolicy(object):
+    """
+    Whether a destination is bridged, terminating SSH on both sides so sessions can be recorded, or
+    passed through as a TCP relay. Destinations are networks or host patterns as in AclPolicy, the
+    most specific match decides and bridge wins a tie.
+    """
+
+    def __init__(self, default, bridge_targets=(), passthrough_targets=()):
+        if default not in ('bridge', 'passthrough'): raise ValueError('Invalid bridge mode {}'.format(default))
+        self.__default = default == 'passthrough'
+        self.__targets = _Targets()
+        for target in bridge_targets: self.__targets.add(str(target), True, None)
+        for target in passthrough_targets: self.__targets.add(str(target), False, None)
+
+
+    def passthrough(self, host, port):
+        """Return whether host:port is passed through"""
+        key, data = _key(host)
+        m = getattr(self.__targets, key).lookup(data, port)
+        return self.__default if m is None else not m[1]
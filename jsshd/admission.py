@@ -0,0 +1,110 @@
+import time
+
+from jsshd import metrics
+
+
+# buckets are pruned once there are this many, full ones carry no state
+_PRUNE_SIZE = 4096
+
+
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'last')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.last = now
+
+    def ready(self, rate, burst, now):
+        """Refill and return whether a token can be taken, without taking it"""
+        self.tokens = min(burst, self.tokens + (now - self.last) * rate)
+        self.last = now
+        return self.tokens >= 1
+
+    def take(self, rate, burst, now):
+        if not self.ready(rate, burst, now): return False
+        self.tokens -= 1
+        return True
+
+
+
+class _RateLimiter(object):
+    def __init__(self):
+        self.rate = 0
+        self.burst = 0
+        self.__buckets = {}
+
+    def ready(self, key, now):
+        if self.rate <= 0: return True
+        return self.__bucket(key, now).ready(self.rate, self.burst, now)
+
+    def take(self, key, now):
+        if self.rate <= 0: return True
+        return self.__bucket(key, now).take(self.rate, self.burst, now)
+
+    def __bucket(self, key, now):
+        bucket = self.__buckets.get(key, None)
+        if bucket is None:
+            if len(self.__buckets) >= _PRUNE_SIZE: self.__prune(now)
+            bucket = self.__buckets[key] = TokenBucket(self.burst, now)
+        return bucket
+
+    def __prune(self, now):
+        full = [k for k, b in self.__buckets.items() if b.tokens + (now - b.last) * self.rate >= self.burst]
+        for k in full: del self.__buckets[k]
+
+
+
+class AdmissionControl(object):
+    """
+    Limits on new bridges: in total, concurrently per user and in connections per second per user
+    and per source address. A limit of 0 disables it. Checking is a few dict operations and
+    happens before a bridge is created, rejections are counted per reason.
+    """
+
+    def __init__(self):
+        self.__max_bridges = 0
+        self.__max_per_user = 0
+        self.__users = _RateLimiter()
+        self.__addrs = _RateLimiter()
+        self.__bridges = 0
+        self.__user_bridges = {}
+
+
+    def configure(self, max_bridges=0, max_per_user=0, user_rate=0, user_burst=1, addr_rate=0, addr_burst=1):
+        """Set the limits, bridges which are open are still counted"""
+        self.__max_bridges = max_bridges
+        self.__max_per_user = max_per_user
+        self.__users.rate, self.__users.burst = user_rate, max(user_burst, 1)
+        self.__addrs.rate, self.__addrs.burst = addr_rate, max(addr_burst, 1)
+
+
+    def admit(self, username, addr):
+        """Count a new bridge of username from addr, or return the reason it is rejected"""
+        if self.__max_bridges and self.__bridges >= self.__max_bridges:
+            reason = 'max_bridges'
+        elif self.__max_per_user and self.__user_bridges.get(username, 0) >= self.__max_per_user:
+            reason = 'max_per_user'
+        else:
+            now = time.monotonic()
+            # tokens are only taken when both buckets have one, a rejection costs the other nothing
+            if not self.__users.ready(username, now):
+                reason = 'user_rate'
+            elif not self.__addrs.ready(addr, now):
+                reason = 'address_rate'
+            else:
+                self.__users.take(username, now)
+                self.__addrs.take(addr, now)
+                self.__bridges += 1
+                self.__user_bridges[username] = self.__user_bridges.get(username, 0) + 1
+                return None
+
+        metrics.admission_rejected.inc(reason)
+        return reason
+
+
+    def release(self, username):
+        self.__bridges -= 1
+        count = self.__user_bridges[username] - 1
+        if count: self.__user_bridges[username] = count
+        else: del self.__user_bridges[username]
@@ -0,0 +1,237 @@
+import time
+import asyncio
+import tracemalloc
+
+import asyncssh
+
+from jsshd import eventloop
+from jsshd.fake.buffer import InputBuffer
+
+
+def _packets(count, size):
+    # 4 byte length header followed by the body, as FakeSSHConnection sees it before decryption
+    body = b'\x00' * size
+    return (len(body).to_bytes(4, 'big') + body) * count
+
+
+def _consume_bytes(data, chunk):
+    # receive path before InputBuffer: every packet slices the remainder of the buffer
+    inpbuf = b''
+    total = 0
+    for i in range(0, len(data), chunk):
+        inpbuf += data[i:i+chunk]
+        while len(inpbuf) >= 4:
+            rem = 4 + int.from_bytes(inpbuf[:4], 'big')
+            if len(inpbuf) < rem: break
+            total += len(inpbuf[4:rem])
+            inpbuf = inpbuf[rem:]
+    return total
+
+
+def _consume_buffer(data, chunk):
+    inpbuf = InputBuffer()
+    total = 0
+    for i in range(0, len(data), chunk):
+        inpbuf.append(data[i:i+chunk])
+        while len(inpbuf) >= 4:
+            rem = 4 + int.from_bytes(inpbuf.peek(4), 'big')
+            if len(inpbuf) < rem: break
+            total += len(inpbuf.peek(rem - 4, 4))
+            inpbuf.consume(rem)
+    return total
+
+
+def _measure(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+
+    # allocations are traced in a second run, tracing skews the timing
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_recv(count=2048, size=16384, chunks=(64 * 1024, 1024 * 1024, None)):
+    """Compare the bytes slicing receive path with InputBuffer for a burst of packets"""
+    data = _packets(count, size)
+    results = []
+    for chunk in chunks:
+        chunk = chunk or len(data)
+        for name, func in (('bytes', _consume_bytes), ('InputBuffer', _consume_buffer)):
+            elapsed, peak = _measure(func, data, chunk)
+            results.append((name, chunk, elapsed, peak))
+            print('recv {:<12} chunk={:>9} packets={} size={}: {:8.2f} ms, {:8.1f} MB/s, peak alloc {:8.1f} KB'.format(
+                name, chunk, count, size, elapsed * 1000, len(data) / elapsed / 2**20, peak / 1024))
+    return results
+
+
+
+class _Sink(asyncio.Protocol):
+    def __init__(self, total, done):
+        self.__left = total
+        self.__done = done
+
+    def data_received(self, data):
+        self.__left -= len(data)
+        if self.__left <= 0 and not self.__done.done(): self.__done.set_result(None)
+
+
+async def _tcp(loop, connections, total, chunk):
+    done = loop.create_future()
+    server = await loop.create_server(lambda: _Sink(total, done), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    start = time.perf_counter()
+    for _ in range(connections):
+        transport, _ = await loop.create_connection(asyncio.Protocol, '127.0.0.1', port)
+        transport.close()
+    setup = time.perf_counter() - start
+
+    _, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = b'\x00' * chunk
+    start = time.perf_counter()
+    for _ in range(total // chunk):
+        writer.write(data)
+        await writer.drain()
+    await done
+    transfer = time.perf_counter() - start
+
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    return setup, transfer
+
+
+def bench_tcp(connections=2000, total=256 * 1024 * 1024, chunk=64 * 1024):
+    """Loopback TCP connection setup rate and throughput of the active event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        setup, transfer = loop.run_until_complete(_tcp(loop, connections, total, chunk))
+    finally:
+        loop.close()
+
+    print('tcp connect: {} connections in {:.2f} s, {:8.1f} conn/s'.format(connections, setup, connections / setup))
+    print('tcp transfer: {} MB in {:.2f} s, {:8.1f} MB/s'.format(total // 2**20, transfer, total / transfer / 2**20))
+    return setup, transfer
+
+
+
+class _SinkSession(asyncssh.SSHServerSession):
+    def connection_made(self, chan): self.__chan = chan
+
+    def shell_requested(self): return True
+
+    def data_received(self, data, datatype): pass
+
+    def eof_received(self): self.__chan.exit(0)
+
+
+class _BenchServer(asyncssh.SSHServer):
+    def begin_auth(self, username): return False
+
+    def session_requested(self): return _SinkSession()
+
+
+def _host_key():
+    for alg in ('ssh-ed25519', 'ecdsa-sha2-nistp256'):
+        try:
+            return asyncssh.generate_private_key(alg)
+        except (ValueError, asyncssh.KeyGenerationError):
+            pass
+    return asyncssh.generate_private_key('ssh-rsa')
+
+
+def _aead(cipher): return 'gcm' in cipher or 'poly1305' in cipher
+
+
+async def _ssh(loop, host_key, kex, cipher, mac, handshakes, total, chunk):
+    server = await asyncssh.create_server(_BenchServer, '127.0.0.1', 0, server_host_keys=[host_key],
+                                          session_encoding=None)
+    port = server.sockets[0].getsockname()[1]
+    options = dict(known_hosts=None, username='bench', client_keys=None, agent_path=None, gss_host=None,
+                   kex_algs=[kex] if kex else (), encryption_algs=[cipher] if cipher else (),
+                   mac_algs=[mac] if mac else ())
+
+    try:
+        start = time.perf_counter()
+        for _ in range(handshakes):
+            conn = await asyncssh.connect('127.0.0.1', port, **options)
+            conn.close()
+            await conn.wait_closed()
+        setup = time.perf_counter() - start
+
+        transfer = None
+        if total:
+            conn = await asyncssh.connect('127.0.0.1', port, **options)
+            writer, _, _ = await conn.open_session(encoding=None)
+            data = b'\x00' * chunk
+            start = time.perf_counter()
+            for _ in range(total // chunk):
+                writer.write(data)
+                await writer.drain()
+            writer.write_eof()
+            await writer.channel.wait_closed()
+            transfer = time.perf_counter() - start
+            conn.close()
+    finally:
+        server.close()
+    return setup, transfer
+
+
+def bench_ssh(kex_algs=('curve25519-sha256', 'ecdh-sha2-nistp256', 'diffie-hellman-group14-sha256'),
+              encryption_algs=('chacha20-poly1305@openssh.com', 'aes128-gcm@openssh.com', 'aes256-gcm@openssh.com',
+                               'aes128-ctr', 'aes256-ctr'),
+              mac_algs=('hmac-sha2-256-etm@openssh.com', 'umac-64-etm@openssh.com', 'hmac-sha1'),
+              handshakes=50, total=64 * 1024 * 1024, chunk=32 * 1024):
+    """
+    Handshakes per second of each kex and MB/s of each cipher and mac over loopback. Client and
+    server run in this process, so every number includes both ends' cost.
+    """
+    host_key = _host_key()
+    print('ssh host key: {}'.format(host_key.get_algorithm()))
+
+    combos = [(kex, None, None, handshakes, 0) for kex in kex_algs]
+    combos += [(None, cipher, mac, 1, total) for cipher in encryption_algs
+               for mac in ((None,) if _aead(cipher) else mac_algs)]
+
+    results = []
+    for kex, cipher, mac, count, size in combos:
+        # asyncssh picks up the current event loop
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            setup, transfer = loop.run_until_complete(_ssh(loop, host_key, kex, cipher, mac, count, size, chunk))
+        except (ValueError, asyncssh.Error) as e:
+            print('ssh kex={} cipher={} mac={}: unsupported ({})'.format(kex, cipher, mac, e))
+            continue
+        finally:
+            loop.close()
+
+        results.append((kex, cipher, mac, setup, transfer))
+        if size:
+            print('ssh transfer cipher={:<32} mac={:<32}: {:8.1f} MB/s'.format(
+                cipher, mac or '(aead)', size / transfer / 2**20))
+        else:
+            print('ssh handshake kex={:<32}: {:8.1f} handshakes/s'.format(kex, count / setup))
+    return results
+
+
+
+BENCHMARKS = {
+    'recv': bench_recv,
+    'tcp': bench_tcp,
+    'ssh': bench_ssh,
+}
+
+
+def run(names, loop='auto'):
+    eventloop.install(loop)
+    loop = asyncio.new_event_loop()
+    print('event loop: {}'.format(eventloop.describe(loop)))
+    loop.close()
+
+    for name in names or BENCHMARKS.keys():
+        BENCHMARKS[name]()
@@ -1,59 +1,188 @@
-import copy
+import socket
 import asyncio
+import itertools
+from types import MappingProxyType
 from asyncssh.constants import *
-
+from asyncssh.misc import DisconnectError
+from asyncssh.packet import Byte, PacketDecodeError
+
+from jsshd import metrics
+from jsshd.trace import TRACER
+from jsshd.timer import Keepalive
+from jsshd.window import ChannelWindows
+from jsshd.logger import logger
 from jsshd.fake import client, server
 
 
 _SERVER_MESSAGES_PROCESSORS = {
+    MSG_IGNORE: 'internal',
+    MSG_UNIMPLEMENTED: 'internal',
+    MSG_DEBUG: 'internal',
+    MSG_GLOBAL_REQUEST: 'internal',
+    MSG_REQUEST_SUCCESS: 'internal',
+    MSG_REQUEST_FAILURE: 'internal',
     MSG_KEXINIT: 'internal',
     MSG_NEWKEYS: 'internal',
     MSG_SERVICE_REQUEST: 'internal',
     MSG_USERAUTH_REQUEST: 'user_auth',
-    MSG_CHANNEL_OPEN: 'redirect',
+    MSG_CHANNEL_OPEN: 'channel_open',
     MSG_CHANNEL_REQUEST: 'redirect',
+    MSG_CHANNEL_SUCCESS: 'redirect',
+    MSG_CHANNEL_FAILURE: 'redirect',
+    MSG_CHANNEL_WINDOW_ADJUST: 'redirect',
     MSG_CHANNEL_DATA: 'redirect',
-    MSG_CHANNEL_CLOSE: 'redirect',
+    MSG_CHANNEL_EXTENDED_DATA: 'redirect',
+    MSG_CHANNEL_CLOSE: 'channel_close',
     MSG_CHANNEL_EOF: 'redirect',
-    MSG_DISCONNECT: 'redirect',
+    MSG_DISCONNECT: 'disconnect',
 }
 
 _CLIENT_MESSAGE_PROCESSORS = {
+    MSG_IGNORE: 'internal',
+    MSG_UNIMPLEMENTED: 'internal',
+    MSG_DEBUG: 'internal',
     MSG_GLOBAL_REQUEST: 'internal',
+    MSG_REQUEST_SUCCESS: 'internal',
+    MSG_REQUEST_FAILURE: 'internal',
+    MSG_KEXINIT: 'internal',
+    MSG_NEWKEYS: 'internal',
     MSG_CHANNEL_OPEN_CONFIRMATION: 'redirect',
+    MSG_CHANNEL_OPEN_FAILURE: 'channel_open_failure',
     MSG_CHANNEL_SUCCESS: 'redirect',
+    MSG_CHANNEL_FAILURE: 'redirect',
     MSG_CHANNEL_WINDOW_ADJUST: 'redirect',
     MSG_CHANNEL_DATA: 'redirect',
     MSG_CHANNEL_REQUEST: 'redirect',
     MSG_CHANNEL_EXTENDED_DATA: 'redirect',
     MSG_CHANNEL_EOF: 'redirect',
-    MSG_CHANNEL_CLOSE: 'redirect',
+    MSG_CHANNEL_CLOSE: 'channel_close',
 }
 
+_REDIRECT_SERVER_MESSAGES = frozenset(k for k, v in _SERVER_MESSAGES_PROCESSORS.items() if v == 'redirect')
+
+_REDIRECT_CLIENT_MESSAGES = frozenset(k for k, v in _CLIENT_MESSAGE_PROCESSORS.items() if v == 'redirect')
+
+# (packets, bytes) lists indexed by packet type
+_SRC_RELAYED = metrics.relayed.direction('src')
+_DST_RELAYED = metrics.relayed.direction('dst')
+
+_RECORDED_MESSAGES = frozenset((MSG_CHANNEL_DATA, MSG_CHANNEL_EXTENDED_DATA))
+
+# bridge ids in packet traces
+_BRIDGE_IDS = itertools.count(1)
+
+
+def _peek_string(packet):
+    """Decode the next string of an SSHPacket without moving its read position"""
+    data, idx = packet._packet, packet._idx
+    if len(data) < idx + 4: raise PacketDecodeError('Incomplete packet')
+
+    end = idx + 4 + int.from_bytes(data[idx:idx+4], 'big')
+    if len(data) < end: raise PacketDecodeError('Incomplete packet')
+    return data[idx+4:end]
+
+
+
+class BridgeParams(object):
+    """Read-only parameters shared by every bridge of a service, built once from Config"""
+
+    __slots__ = ('server', 'client', 'pool', 'buffer_limits', 'slow_login_threshold', 'speculative_connect',
+                 'recorder', 'timers', 'idle_timeout', 'upstream_keepalive', 'windows',
+                 'compression')
+
+    def __init__(self, server_params, client_params, pool=None, buffer_limits=None, slow_login_threshold=None,
+                 speculative_connect=False, recorder=None, timers=None, idle_timeout=0, upstream_keepalive=None,
+                 windows=None, compression=(0, 0)):
+        self.server = MappingProxyType(dict(server_params))
+        self.client = MappingProxyType(dict(client_params))
+        self.pool = pool
+        # (high, low, max_size) of each fake connection's write buffer
+        self.buffer_limits = buffer_limits
+        # seconds from accept to a ready upstream above which a login is logged
+        self.slow_login_threshold = slow_login_threshold
+        # connect and exchange keys with the upstream before the client's username is known
+        self.speculative_connect = speculative_connect
+        # SessionRecorder of the channel data, None disables recording
+        self.recorder = recorder
+        # TimerWheel for the idle timeout (seconds without relayed packets, 0 disables it) and for
+        # the (interval, count_max) keepalive of the upstream
+        self.timers = timers
+        self.idle_timeout = idle_timeout
+        self.upstream_keepalive = upstream_keepalive
+        # (min_window, max_window) of the bridge's own channel flow control, None relays the
+        # windows of the two ends unchanged
+        self.windows = windows
+        # (disable_ratio, retry_interval) of each leg's compression, see FakeSSHConnection.set_compression
+        self.compression = compression
+
+
+
+class _ListenerRelay(object):
+    """Listener of a fake connection whose target can be swapped, e.g. when a pooled upstream changes bridge"""
+
+    def __init__(self, target): self.target = target
+
+    def __getattr__(self, item): return getattr(self.target, item)
+
+
 
 class Bridge(object):
 
     SRC_PACKET_HANDLERS = {}
     DST_PACKET_HANDLERS = {}
 
-    def __init__(self, orig_host, orig_port, server_params, client_params):
+    def __init__(self, orig_host, orig_port, dest_host, dest_port, params, accepted_at=None, on_close=None):
         super(Bridge, self).__init__()
+        self.__id = next(_BRIDGE_IDS)
         self.__orig_host = orig_host
         self.__orig_port = orig_port
-        self.__server_params = copy.deepcopy(server_params)
-        self.__client_params = copy.deepcopy(client_params)
+        self.__dest_host = dest_host
+        self.__dest_port = dest_port
+        self.__username = None
+        self.__params = params
+        self.__pool = params.pool
         self.__loop = asyncio.get_event_loop()
         self.__src = None
         self.__dst = None
+        self.__dst_task = None
+        self.__speculative = None
+        self.__recording = None
+        # recipient channel fields of the recorded session in packets to the upstream and to the user
+        self.__recorded_dst = None
+        self.__recorded_src = None
+        self.__keepalive = None
+        self.__idle_timer = None
+        self.__activity = None
+        self.__windows = None
+        self.__src_rtt_measured = False
+        self.__closed = False
+        self.__on_close = on_close
+        metrics.bridges.inc()
+
+        # loop time of each connection setup step, see __observe_login
+        self.__times = {'created': self.__loop.time()}
+        if accepted_at is not None: self.__times['accepted'] = accepted_at
+
+        # channels opened on the destination and CLOSE messages seen in each direction
+        self.__channels_opened = 0
+        self.__src_closes = 0
+        self.__dst_closes = 0
+
+
+
+    def __connection_wrapper(self, conn):
+        # set listener and flow control limits
+        conn.listener_relay = _ListenerRelay(self)
+        conn.add_listener(conn.listener_relay)
+        if self.__params.buffer_limits is not None: conn.set_write_buffer_limits(*self.__params.buffer_limits)
+        if TRACER.enabled: conn.tracer, conn.trace_id = TRACER, self.__id
+        conn.set_compression(metrics.compression.leg('src' if conn.is_server() else 'dst'), *self.__params.compression,
+                             timers=self.__params.timers)
+        return conn
 
 
-        # set listener
-        def connection_wrapper(conn):
-            conn.add_listener(self)
-            return conn
-        self.__server_params['connection_wrapper'] = connection_wrapper
-        self.__client_params['connection_wrapper'] = connection_wrapper
-
+    @property
+    def id(self): return self.__id
 
     @property
     def source(self): return self.__src
@@ -61,30 +190,58 @@ class Bridge(object):
     @property
     def destination(self): return self.__dst
 
+    @property
+    def username(self): return self.__username
+
     async def initialize(self):
-        await self.__create_fake_server()
+        if self.__params.speculative_connect:
+            self.__speculative = self.__loop.create_task(self.__connect_upstream(None, defer_auth=True))
+
+        try:
+            await self.__create_fake_server()
+        except Exception:
+            self.__cancel_speculative()
+            self.__close()
+            raise
         return self.__src
 
 
     def connection_made(self, transport, messager):
         src, dst = messager, self.__src if self.__src == messager else self.__dst
         if src == self.__src:
-            print('fake server connection_made')
+            logger.debug('bridge {}:{} fake server connection_made'.format(self.__orig_host, self.__orig_port))
         else:
-            print('fake client connection_made')
+            logger.debug('bridge {}:{} fake client connection_made'.format(self.__orig_host, self.__orig_port))
+
+
+    def __close(self):
+        if self.__closed: return
+        self.__closed = True
+        metrics.bridges.dec()
+        if self.__on_close is not None: self.__on_close()
 
 
     def connection_lost(self, exc, messager):
         src, dst = messager, self.__src if self.__src == messager else self.__dst
         if src == self.__src:
-            print('fake server connection_lost')
+            logger.debug('bridge {}:{} fake server connection_lost'.format(self.__orig_host, self.__orig_port))
+            if exc is not None and TRACER.enabled: TRACER.dump(self.__id, 'bridge {} lost: {}'.format(self.__id, exc))
+            self.__cancel_speculative()
+            self.__release_fake_client()
+            if self.__recording is not None: self.__recording.close()
+            self.__close()
         else:
-            print('fake client connection_lost')
+            logger.debug('bridge {}:{} fake client connection_lost'.format(self.__orig_host, self.__orig_port))
 
 
-    def pause_writing(self, messager): pass
+    # stop reading on one side while the other side cannot write
+    def pause_writing(self, messager):
+        peer = self.__dst if messager == self.__src else self.__src
+        if peer is not None: peer.pause_reading()
 
-    def resume_writing(self, messager): pass
+    def resume_writing(self, messager):
+        peer = self.__dst if messager == self.__src else self.__src
+        if peer is not None: peer.resume_reading()
 
 
     def __process_src_packet(self, pkttype, pktid, packet):
@@ -100,18 +257,164 @@ class Bridge(object):
 
 
     async def __create_fake_server(self):
-        self.__src = await server.create_connection(**self.__server_params)
+        self.__src = await server.create_connection(connection_wrapper=self.__connection_wrapper,
+                                                    **self.__params.server)
 
         # set process_packet_callback
         self.__src.process_packet_callback = self.__process_src_packet
 
 
+    async def __connect_upstream(self, username, defer_auth=False):
+        # resolve separately so DNS shows up as its own phase
+        self.__times['upstream_start'] = self.__loop.time()
+        addrs = await self.__loop.getaddrinfo(self.__dest_host, self.__dest_port, type=socket.SOCK_STREAM)
+        self.__times['upstream_resolved'] = self.__loop.time()
+
+        return await client.create_connection(host=self.__dest_host, port=self.__dest_port, username=username,
+                                              connection_wrapper=self.__connection_wrapper,
+                                              connect_addrs=addrs, defer_auth=defer_auth,
+                                              **self.__params.client)
+
+
+    def __cancel_speculative(self):
+        task, self.__speculative = self.__speculative, None
+        if task is None: return
+        if not task.done(): task.cancel()
+        elif not task.cancelled() and task.exception() is None: task.result().close()
+
+
     async def __create_fake_client(self):
-        self.__dst = await client.create_connection(**self.__client_params)
+        if self.__pool is not None:
+            self.__dst = self.__pool.acquire(self.__dest_host, self.__dest_port, self.__username)
+
+        # a pooled upstream is already authenticated, the speculative one is not needed then
+        if self.__dst is not None: self.__cancel_speculative()
+
+        if self.__dst is None:
+            speculative, self.__speculative = self.__speculative, None
+            try:
+                if speculative is None:
+                    self.__dst = await self.__connect_upstream(self.__username)
+                else:
+                    # kept in __dst while authenticating so that losing the source closes it
+                    self.__dst = await speculative
+                    await self.__dst.start_auth(self.__username)
+            except Exception as e:
+                metrics.upstream_connect_failures.inc()
+                logger.warning('connect {}@{}:{} failed: {}'.format(self.__username, self.__dest_host,
+                                                                     self.__dest_port, e))
+                if TRACER.enabled: TRACER.dump(self.__id, 'bridge {} upstream failed: {}'.format(self.__id, e))
+                raise
+        else:
+            self.__dst.listener_relay.target = self
+            if self.__dst.write_paused: self.__src.pause_reading()
 
         # set process_packet_callback
         self.__dst.process_packet_callback = self.__process_dst_packet
 
+        # relay redirected packet types as raw payloads in both directions
+        self.__src.set_redirect(self.__redirect_src_payload, _REDIRECT_SERVER_MESSAGES)
+        self.__dst.set_redirect(self.__redirect_dst_payload, _REDIRECT_CLIENT_MESSAGES)
+
+        if self.__params.windows is not None:
+            # the src leg is measured once the user is authenticated, see _process_src_channel_open
+            self.__windows = ChannelWindows(self.__src, self.__dst, *self.__params.windows)
+            self.__dst.create_task(self.__measure_rtt('dst', self.__dst))
+
+        if self.__params.recorder is not None:
+            # user and host are client-chosen, they only go into the header
+            self.__recording = self.__params.recorder.open(
+                self.__id, user=self.__username, host='{}:{}'.format(self.__dest_host, self.__dest_port),
+                title='{}@{}:{} from {}:{}'.format(self.__username, self.__dest_host, self.__dest_port,
+                                                   self.__orig_host, self.__orig_port))
+
+        timers = self.__params.timers
+        if timers is not None:
+            if self.__params.upstream_keepalive:
+                self.__keepalive = Keepalive(timers, self.__dst, *self.__params.upstream_keepalive)
+            if self.__params.idle_timeout:
+                self.__activity = self.__packets_received()
+                self.__idle_timer = timers.call_later(self.__params.idle_timeout, self.__check_idle)
+
+        self.__times['upstream_ready'] = self.__loop.time()
+        self.__observe_login()
+
+
+    async def __measure_rtt(self, leg, conn):
+        # a global request is answered by the peer's ssh layer, its round trip is the leg's rtt
+        start = self.__loop.time()
+        await conn._make_global_request(b'keepalive@openssh.com')
+        if self.__windows is not None: self.__windows.rtt[leg] = self.__loop.time() - start
+
+
+    def __packets_received(self):
+        # packets received on both legs, without the replies to our keepalives
+        replies = 0 if self.__keepalive is None else self.__keepalive.replies
+        return self.__src._recv_seq + self.__dst._recv_seq - replies
+
+
+    def __check_idle(self):
+        self.__idle_timer = None
+        if self.__closed or self.__dst is None: return
+
+        activity = self.__packets_received()
+        if activity == self.__activity:
+            logger.info('bridge {}@{}:{} from {}:{} idle for {}s, closing'.format(
+                self.__username, self.__dest_host, self.__dest_port, self.__orig_host, self.__orig_port,
+                self.__params.idle_timeout))
+            self.__src.abort()
+            return
+
+        self.__activity = activity
+        self.__idle_timer = self.__params.timers.call_later(self.__params.idle_timeout, self.__check_idle)
+
+
+    def __observe_login(self):
+        t = dict(self.__times)
+        for name, conn in (('src', self.__src), ('dst', self.__dst)):
+            for k, v in conn.timestamps.items(): t['{}_{}'.format(name, k)] = v
+        if 'dst_auth_started' not in t and 'dst_kex_complete' in t: t['dst_auth_started'] = t['dst_kex_complete']
+
+        # phase -> (start, end), phases missing a timestamp (e.g. a pooled upstream) are skipped
+        phases = (('bridge_kex', 'created', 'src_kex_complete'),
+                  ('bridge_auth_request', 'src_kex_complete', 'auth_requested'),
+                  ('upstream_dns', 'upstream_start', 'upstream_resolved'),
+                  ('upstream_connect', 'upstream_resolved', 'dst_connection_made'),
+                  ('upstream_kex', 'dst_connection_made', 'dst_kex_complete'),
+                  ('upstream_auth', 'dst_auth_started', 'upstream_ready'),
+                  ('bridge_total', 'created', 'upstream_ready'),
+                  ('login_total', 'accepted', 'upstream_ready'))
+
+        durations = []
+        for phase, start, end in phases:
+            if start not in t or end not in t or t[end] < t[start]: continue
+            metrics.login_phases.observe(phase, t[end] - t[start])
+            durations.append((phase, t[end] - t[start]))
+
+        total = t['upstream_ready'] - t.get('accepted', t['created'])
+        threshold = self.__params.slow_login_threshold
+        if threshold is not None and total > threshold:
+            logger.warning('slow login {}@{}:{} from {}:{} took {:.3f}s: {}'.format(
+                self.__username, self.__dest_host, self.__dest_port, self.__orig_host, self.__orig_port, total,
+                ' '.join('{}={:.3f}'.format(k, v) for k, v in durations)))
+
+
+    def __release_fake_client(self):
+        if self.__keepalive is not None: self.__keepalive.cancel()
+        if self.__idle_timer is not None: self.__idle_timer.cancel()
+        self.__keepalive = self.__idle_timer = None
+
+        dst, self.__dst = self.__dst, None
+        if dst is None: return
+        dst.resume_reading()
+
+        # only an authenticated upstream with every channel closed on both sides can be reused
+        reusable = self.__pool is not None and dst._transport is not None and dst._auth_complete and \
+                   self.__channels_opened == self.__src_closes == self.__dst_closes
+
+        if not reusable or not self.__pool.release(self.__dest_host, self.__dest_port, self.__username, dst):
+            dst.close()
+
 
 # ================================ MESSAGES PROCESSORS ================================ #
 
@@ -119,24 +422,107 @@ class Bridge(object):
 
     def _process_dst_internal(self, *args, **kwargs): return None
 
+    def __redirect_src_payload(self, pkttype, payload):
+        _SRC_RELAYED[0][pkttype] += 1
+        _SRC_RELAYED[1][pkttype] += len(payload)
+        if self.__recording is not None and pkttype == MSG_CHANNEL_DATA and payload[1:5] == self.__recorded_dst:
+            self.__recording.record('i', pkttype, payload)
+        if self.__windows is None or not self.__windows.from_src(pkttype, payload): self.__dst.send_payload(payload)
+
+    def __redirect_dst_payload(self, pkttype, payload):
+        _DST_RELAYED[0][pkttype] += 1
+        _DST_RELAYED[1][pkttype] += len(payload)
+        if self.__recording is not None and payload[1:5] == self.__recorded_src:
+            if pkttype in _RECORDED_MESSAGES: self.__recording.record('o', pkttype, payload)
+            elif pkttype == MSG_CHANNEL_OPEN_CONFIRMATION: self.__recorded_dst = payload[5:9]
+        if self.__windows is None: self.__src.send_payload(payload)
+        elif pkttype == MSG_CHANNEL_OPEN_CONFIRMATION: self.__windows.confirm(payload)
+        elif not self.__windows.from_dst(pkttype, payload): self.__src.send_payload(payload)
+
     def _process_src_redirect(self, pkttype, pktid, packet):
-        self.__dst.send_packet(pkttype, packet.get_remaining_payload())
+        payload = packet.get_remaining_payload()
+        _SRC_RELAYED[0][pkttype] += 1
+        _SRC_RELAYED[1][pkttype] += len(payload) + 1
+        if self.__windows is None: self.__dst.send_packet(pkttype, payload)
+        elif pkttype == MSG_CHANNEL_OPEN: self.__windows.open(Byte(pkttype) + payload)
+        elif not self.__windows.from_src(pkttype, Byte(pkttype) + payload): self.__dst.send_packet(pkttype, payload)
         return True
 
     def _process_dst_redirect(self, pkttype, pktid, packet):
-        self.__src.send_packet(pkttype, packet.get_remaining_payload())
+        payload = packet.get_remaining_payload()
+        _DST_RELAYED[0][pkttype] += 1
+        _DST_RELAYED[1][pkttype] += len(payload) + 1
+        if self.__windows is None: self.__src.send_packet(pkttype, payload)
+        elif pkttype == MSG_CHANNEL_OPEN_FAILURE:
+            self.__windows.fail(Byte(pkttype) + payload)
+            self.__src.send_packet(pkttype, payload)
+        elif not self.__windows.from_dst(pkttype, Byte(pkttype) + payload): self.__src.send_packet(pkttype, payload)
         return True
 
+    def _process_src_channel_open(self, pkttype, pktid, packet):
+        self.__channels_opened += 1
+        # the user's first session is recorded, forwarded ports and agent channels are not
+        if self.__recording is not None and self.__recorded_src is None and _peek_string(packet) == b'session':
+            offset = 4 + len(b'session')
+            self.__recorded_src = packet.get_remaining_payload()[offset:offset+4]
+        # channels are opened after the user's auth, a global request sent during it waits for its round trips
+        if self.__windows is not None and not self.__src_rtt_measured:
+            self.__src_rtt_measured = True
+            self.__src.create_task(self.__measure_rtt('src', self.__src))
+        return self._process_src_redirect(pkttype, pktid, packet)
+
+    def _process_src_disconnect(self, pkttype, pktid, packet):
+        # not relayed: the upstream may go back to the pool, and a closed one gets its DISCONNECT
+        # from __release_fake_client, nothing may follow a DISCONNECT on the wire
+        return True
+
+    def _process_src_channel_close(self, pkttype, pktid, packet):
+        self.__src_closes += 1
+        return self._process_src_redirect(pkttype, pktid, packet)
+
+    def _process_dst_channel_close(self, pkttype, pktid, packet):
+        self.__dst_closes += 1
+        return self._process_dst_redirect(pkttype, pktid, packet)
+
+    def _process_dst_channel_open_failure(self, pkttype, pktid, packet):
+        # a refused channel never needs closing
+        self.__src_closes += 1
+        self.__dst_closes += 1
+        return self._process_dst_redirect(pkttype, pktid, packet)
+
     def _process_src_user_auth(self, pkttype, pktid, packet):
+        metrics.auth_attempts.inc('bridge')
+
+        # the upstream is created once for the first username, later auth requests only wait for it
+        username = _peek_string(packet).decode('utf-8')
+        if self.__dst_task is None:
+            self.__times['auth_requested'] = self.__loop.time()
+            self.__username = username
+            self.__dst_task = self.__loop.create_task(self.__create_fake_client())
+        elif username != self.__username:
+            raise DisconnectError(DISC_PROTOCOL_ERROR, 'Change of username not allowed')
+
         async def process():
-            p = copy.deepcopy(packet)
-            self.__client_params['username'] = p.get_string().decode('utf-8')
+            src = self.__src
             try:
-                await self.__create_fake_client()
-                self.__src.raw_process_packet(pkttype, pktid, packet)
+                await asyncio.shield(self.__dst_task)
             except Exception as e:
+                # every queued attempt gets here, only the first one disconnects
+                if src._transport is None: return
+                logger.info('bridge {}:{} upstream {}@{}:{} unavailable: {}'.format(
+                    self.__orig_host, self.__orig_port, self.__username, self.__dest_host, self.__dest_port, e))
+                src.disconnect(DISC_BY_APPLICATION, 'Upstream connection failed')
                 return
 
+            # errors are handled like asyncssh does for packets processed in data_received
+            try:
+                src.raw_process_packet(pkttype, pktid, packet)
+            except DisconnectError as exc:
+                src._send_disconnect(exc.code, exc.reason, exc.lang)
+                src._force_close(exc)
+            except Exception:
+                src.internal_error()
+
         self.__loop.create_task(process())
         return True
 
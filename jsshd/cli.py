@@ -6,6 +6,7 @@ import argparse
 from functools import partial
 
 from jsshd.sshd import Service
+from jsshd.supervisor import Supervisor
 from jsshd.config import Config
 from jsshd import logger
 
@@ -38,6 +39,13 @@ def load_config():
     start.set_defaults(func=partial(_parse_command, 'start'))
     start.add_argument('-c', '--config', type=str, default=None, help='Config module path')
     start.add_argument('-s', '--set', type=str, action=DictAction, default={}, help='Set specific key in config')
+    start.add_argument('-w', '--workers', type=int, default=None, help='Number of worker processes, overrides WORKERS in config')
+
+    # bench
+    bench = sparser.add_parser('bench', help='Run benchmarks on this machine')
+    bench.set_defaults(func=partial(_parse_command, 'bench'))
+    bench.add_argument('names', type=str, nargs='*', help='Benchmarks to run, default all')
+    bench.add_argument('-l', '--loop', type=str, default='auto', help='Event loop: auto, uvloop or asyncio')
 
     args = parser.parse_args()
     if getattr(args, 'func', None) is None:
@@ -56,13 +64,23 @@ def cmd_start(args):
     config = Config(args.config, args.set)
 
     # init logger
-    logger.initialize(config.LOG_FILE_PATH)
+    logger.initialize(config.LOG_FILE_PATH, config.log_levels, config.log_queue_size,
+                      config.log_rotate_bytes, config.log_rotate_when, config.log_backup_count)
 
-    # run service
-    service = Service(config)
+    # run service, in worker processes if asked to
+    workers = args.workers if args.workers is not None else config.workers
+    if workers > 0:
+        service = Supervisor(config, workers)
+    else:
+        service = Service(config)
     service()
 
 
+def cmd_bench(args):
+    from jsshd import benchmark
+    benchmark.run(args.names, args.loop)
+
+
 def main():
     cmd, args = load_config()
 
@@ -72,6 +90,9 @@ def main():
     elif cmd == 'start':
         cmd_start(args)
 
+    elif cmd == 'bench':
+        cmd_bench(args)
+
     else:
         raise Exception('Invalid command {0}'.format(cmd))
 
@@ -11,6 +11,7 @@ class Config(object):
         from jsshd import default_config
 
         self.__config_path = config_path
+        self.__set_dict = set_dict
         self.__config_dict, \
         self.__config_attrs = Config.__load_config_file(config_path,
                                                         default_config.__file__,
@@ -27,6 +28,10 @@ class Config(object):
 
     def __str__(self): return yaml.dump(self.__config_dict)
 
+    def reload(self):
+        """Load the config file again with the same overrides, the running config is left untouched"""
+        return Config(self.__config_path, self.__set_dict)
+
 
     @staticmethod
     def __load_config_file(config_file_path, default_config_path, config_name, undefined_name, set_dict):
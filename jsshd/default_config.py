@@ -12,10 +12,213 @@ class Undefined(Config):
 PORT = Config(8022)
 
 
+# seconds connections get to close on SIGTERM before they are closed, SIGHUP reloads without closing them
+DRAIN_TIMEOUT = Config(30.0)
+
+
+# number of worker processes sharing PORT through SO_REUSEPORT, 0 runs the service in this process
+WORKERS = Config(0)
+
+
+# event loop implementation: auto (uvloop when installed), uvloop or asyncio
+EVENT_LOOP = Config('auto')
+
+
+# authorized_keys files named after their user, permitopen options limit the user's targets.
+# Without AUTHORIZED_KEYS_DIR and AUTHORIZED_KEYS_DB every key is accepted
+AUTHORIZED_KEYS_DIR = Config(None)
+
+
+# SQLite database with a table authorized_keys(username, key) of authorized_keys lines
+AUTHORIZED_KEYS_DB = Config(None)
+
+
+# yaml destination acl of users and groups, see jsshd.acl.AclPolicy. None allows every target
+ACL_FILE = Config(None)
+
+
 SERVER_HOST_KEYS = Config(os.path.expanduser('~/.ssh/id_rsa'))
 
 
 CLIENT_KEYS = Config([os.path.expanduser('~/.ssh/id_rsa')])
 
 
-LOG_FILE_PATH = Config(None)
\ No newline at end of file
+# algorithm preference lists of the user side (user connection and bridges' fake servers) and of
+# the upstream side, () keeps the asyncssh defaults. `jsshd bench ssh` compares their cost, e.g.
+# ['curve25519-sha256'], ['chacha20-poly1305@openssh.com', 'aes128-gcm@openssh.com'] for bulk relays
+SERVER_KEX_ALGS = Config(())
+
+
+SERVER_ENCRYPTION_ALGS = Config(())
+
+
+SERVER_MAC_ALGS = Config(())
+
+
+UPSTREAM_KEX_ALGS = Config(())
+
+
+UPSTREAM_ENCRYPTION_ALGS = Config(())
+
+
+UPSTREAM_MAC_ALGS = Config(())
+
+
+LOG_FILE_PATH = Config(None)
+
+
+# level per subsystem: jsshd, asyncssh and asyncssh.fake (packets of the bridges' fake connections)
+LOG_LEVELS = Config({'jsshd': 'INFO', 'asyncssh': 'INFO', 'asyncssh.fake': 'WARNING'})
+
+
+# records waiting for the logging thread, further records are dropped and counted
+LOG_QUEUE_SIZE = Config(10000)
+
+
+# rotate LOG_FILE_PATH after this many bytes, or else at LOG_ROTATE_WHEN ('midnight', 'h', ...) if set
+LOG_ROTATE_BYTES = Config(0)
+
+
+LOG_ROTATE_WHEN = Config(None)
+
+
+LOG_BACKUP_COUNT = Config(5)
+
+
+# idle authenticated upstream connections kept for new bridges, 0 disables the pool. A reload starts
+# a new pool with these settings
+UPSTREAM_POOL_SIZE = Config(64)
+
+
+UPSTREAM_POOL_MAX_PER_HOST = Config(4)
+
+
+UPSTREAM_POOL_IDLE_TIMEOUT = Config(300.0)
+
+
+BRIDGE_WRITE_HIGH_WATERMARK = Config(256 * 1024)
+
+
+BRIDGE_WRITE_LOW_WATERMARK = Config(64 * 1024)
+
+
+BRIDGE_MAX_BUFFER_SIZE = Config(16 * 1024 * 1024)
+
+
+# serve Prometheus metrics on 'host:port' or 'unix:/path', None disables it
+METRICS_ADDRESS = Config(None)
+
+
+# logins whose upstream is ready later than this many seconds after accept are logged with their phases
+SLOW_LOGIN_THRESHOLD = Config(3.0)
+
+
+# connect and exchange keys with the upstream while the client is still authenticating, only auth waits for it
+UPSTREAM_SPECULATIVE_CONNECT = Config(False)
+
+
+# trace 1 in PACKET_TRACE_RATE packets of the bridges into a ring buffer of PACKET_TRACE_SIZE entries,
+# 0 disables it. The buffer is logged on SIGUSR1 and, for its packets, when a bridge fails
+PACKET_TRACE_RATE = Config(0)
+
+
+PACKET_TRACE_SIZE = Config(4096)
+
+
+# record the channel data of every bridge in asciicast v2 files under this directory, None disables it.
+# A reload can enable recording, changes of RECORDING_* after that need a restart
+RECORDING_DIR = Config(None)
+
+
+# gzip recordings
+RECORDING_COMPRESS = Config(False)
+
+
+# bytes of session data waiting for the recording thread, further data is dropped from recordings
+RECORDING_MAX_BACKLOG = Config(8 * 1024 * 1024)
+
+
+# bridge limits, 0 disables a limit. Rates are new bridges per second with bursts of up to BURST bridges
+MAX_BRIDGES = Config(0)
+
+
+MAX_BRIDGES_PER_USER = Config(0)
+
+
+USER_CONNECT_RATE = Config(0)
+
+
+USER_CONNECT_BURST = Config(10)
+
+
+ADDRESS_CONNECT_RATE = Config(0)
+
+
+ADDRESS_CONNECT_BURST = Config(20)
+
+
+# seconds between keepalive probes of quiet user and upstream connections, 0 disables them.
+# A connection is closed after KEEPALIVE_COUNT_MAX unanswered probes
+KEEPALIVE_INTERVAL = Config(30.0)
+
+
+UPSTREAM_KEEPALIVE_INTERVAL = Config(30.0)
+
+
+KEEPALIVE_COUNT_MAX = Config(3)
+
+
+# close bridges which relayed no packet for this many seconds, 0 disables it
+BRIDGE_IDLE_TIMEOUT = Config(0)
+
+
+# let the bridge run the flow control of each channel leg by leg: the window granted to each side
+# grows from BRIDGE_MIN_WINDOW with that leg's rtt and the channel's throughput up to
+# BRIDGE_MAX_WINDOW, which also bounds the data buffered per channel and direction
+BRIDGE_ADAPTIVE_WINDOW = Config(False)
+
+
+BRIDGE_MIN_WINDOW = Config(2 * 1024 * 1024)
+
+
+BRIDGE_MAX_WINDOW = Config(32 * 1024 * 1024)
+
+
+# compression of the bridges' legs: the user side (fake servers, where the user's client picks
+# from this list) and the upstream side. A poorly compressing leg, e.g. scp of compressed files,
+# is renegotiated to none once its sent data compresses worse than COMPRESSION_DISABLE_RATIO
+# (0 never) and compression is offered again after COMPRESSION_RETRY_INTERVAL seconds (0 never)
+SERVER_COMPRESSION_ALGS = Config(['zlib@openssh.com', 'none'])
+
+
+UPSTREAM_COMPRESSION_ALGS = Config(['none'])
+
+
+COMPRESSION_DISABLE_RATIO = Config(0)
+
+
+COMPRESSION_RETRY_INTERVAL = Config(300.0)
+
+
+# 'bridge' terminates SSH on both sides of a direct-tcpip request, so sessions can be recorded and
+# upstreams pooled, 'passthrough' relays its bytes to the destination like ssh -J and saves the
+# second encryption. Destinations (networks or host patterns as in ACL_FILE) of BRIDGE_TARGETS and
+# PASSTHROUGH_TARGETS override it, the most specific one wins and bridge wins a tie
+BRIDGE_MODE = Config('bridge')
+
+
+BRIDGE_TARGETS = Config([])
+
+
+PASSTHROUGH_TARGETS = Config([])
+
+
+# receive window and max packet size of passed through channels, and the destination socket's
+# SO_SNDBUF/SO_RCVBUF (0 keeps the system's)
+PASSTHROUGH_WINDOW = Config(8 * 1024 * 1024)
+
+
+PASSTHROUGH_MAX_PKTSIZE = Config(32768)
+
+
+PASSTHROUGH_SOCKET_BUFFER = Config(4 * 1024 * 1024)
\ No newline at end of file
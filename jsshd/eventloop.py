@@ -0,0 +1,24 @@
+import asyncio
+
+
+EVENT_LOOPS = ('auto', 'uvloop', 'asyncio')
+
+
+def install(name='auto'):
+    """Install the event loop policy named by the EVENT_LOOP config key, uvloop is used by 'auto' when installed"""
+    if name not in EVENT_LOOPS: raise Exception('Invalid event loop {}, must be one of {}'.format(name, EVENT_LOOPS))
+
+    if name != 'asyncio':
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return
+        except ImportError:
+            if name == 'uvloop': raise Exception('EVENT_LOOP is uvloop but uvloop is not installed')
+
+    asyncio.set_event_loop_policy(None)
+
+
+def describe(loop=None):
+    loop = loop or asyncio.get_event_loop()
+    return '{}.{}'.format(type(loop).__module__, type(loop).__name__)
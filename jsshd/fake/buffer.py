@@ -0,0 +1,67 @@
+
+# consumed bytes are only moved out of the buffer once they exceed this and half of its size
+_COMPACT_THRESHOLD = 64 * 1024
+
+
+class InputBuffer(object):
+    """
+    Receive buffer which consumes data in place.
+
+    Data is consumed by advancing a read offset, so taking a packet off the front of a large
+    burst copies only that packet instead of the whole remainder. A chunk received into an
+    empty buffer is kept as is, it is only copied into a bytearray when more data arrives
+    before it has been consumed.
+    """
+
+    __slots__ = ('_buf', '_pos')
+
+    def __init__(self, data=b''):
+        self._buf = bytes(data)
+        self._pos = 0
+
+    def __len__(self): return len(self._buf) - self._pos
+
+    def __bool__(self): return len(self._buf) > self._pos
+
+
+    def append(self, data):
+        if self._pos >= len(self._buf):
+            self._buf = data if data.__class__ is bytes else bytes(data)
+            self._pos = 0
+        elif self._buf.__class__ is bytearray:
+            self._buf += data
+        else:
+            with memoryview(self._buf) as view:
+                self._buf = bytearray(view[self._pos:])
+            self._buf += data
+            self._pos = 0
+
+
+    def find(self, sub):
+        idx = self._buf.find(sub, self._pos)
+        return idx if idx < 0 else idx - self._pos
+
+
+    def peek(self, size, offset=0):
+        start = self._pos + offset
+        if self._buf.__class__ is bytes: return self._buf[start:start+size]
+        with memoryview(self._buf) as view:
+            return view[start:start+size].tobytes()
+
+
+    def consume(self, size):
+        self._pos += size
+        buf_len = len(self._buf)
+
+        if self._pos >= buf_len:
+            self._buf = b''
+            self._pos = 0
+        elif self._pos >= _COMPACT_THRESHOLD and self._pos * 2 >= buf_len and self._buf.__class__ is bytearray:
+            del self._buf[:self._pos]
+            self._pos = 0
+
+
+    def read(self, size):
+        data = self.peek(size)
+        self.consume(size)
+        return data
@@ -0,0 +1,98 @@
+import os
+import time
+import asyncio
+
+from jsshd.logger import logger
+
+
+_DEFAULT_CHECK_INTERVAL = 5.0
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def freeze(v):
+    """Turn a (possibly nested) config value into a hashable cache key"""
+    if isinstance(v, dict): return tuple(sorted((k, freeze(x)) for k, x in v.items()))
+    if isinstance(v, (list, tuple)): return tuple(freeze(x) for x in v)
+    return v
+
+
+def file_paths(v):
+    """Collect file paths referenced by a keylist / certlist style argument"""
+    if isinstance(v, str): return [v, v + '-cert.pub']
+    if isinstance(v, (list, tuple)): return [p for x in v for p in file_paths(x)]
+    return []
+
+
+
+class FileStamp(object):
+    def __init__(self, paths):
+        self.__paths = tuple(paths)
+        self.__mtimes = self.__stat()
+
+    def __stat(self): return tuple(_mtime(p) for p in self.__paths)
+
+    def changed(self): return self.__stat() != self.__mtimes
+
+
+
+class FileCache(object):
+    """
+    Process-wide cache of objects built from files on disk.
+
+    factory(*args) must return an object with a `paths` attribute listing the files it was
+    built from. Stale entries are revalidated in the default executor so that a lookup never
+    touches the disk on the event loop once the entry has been built.
+    """
+
+    def __init__(self, factory, check_interval=_DEFAULT_CHECK_INTERVAL):
+        self.__factory = factory
+        self.__check_interval = check_interval
+        self.__entries = {}
+
+
+    def build(self, *args):
+        """Build the entry of args without caching it, safe to call in an executor"""
+        return freeze(args), self.__build(args)
+
+
+    def replace(self, *built):
+        """Drop every entry and cache the ones returned by build()"""
+        self.__entries = dict(built)
+
+
+    async def get(self, *args, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        key = freeze(args)
+        entry = self.__entries.get(key, None)
+
+        if entry is None:
+            entry = await loop.run_in_executor(None, self.__build, args)
+            self.__entries[key] = entry
+
+        elif not entry[3] and time.monotonic() - entry[2] > self.__check_interval:
+            entry[3] = True
+            loop.create_task(self.__revalidate(loop, key, args, entry))
+
+        return entry[0]
+
+
+    def __build(self, args):
+        value = self.__factory(*args)
+        return [value, FileStamp(value.paths), time.monotonic(), False]
+
+
+    async def __revalidate(self, loop, key, args, entry):
+        try:
+            if await loop.run_in_executor(None, entry[1].changed):
+                self.__entries[key] = await loop.run_in_executor(None, self.__build, args)
+        except Exception as e:
+            logger.warning('refresh {} failed: {}'.format(self.__factory.__name__, e))
+        finally:
+            entry[2] = time.monotonic()
+            entry[3] = False
@@ -1,5 +1,7 @@
 import os
+import time
 import asyncio
+import functools
 
 from asyncssh.connection import SSHClient, \
     _validate_version, _validate_algs, load_certificates, \
@@ -7,7 +9,13 @@ from asyncssh.connection import SSHClient, \
     load_default_host_public_keys, load_keypairs, load_default_keypairs, connect_agent,\
     _DEFAULT_REKEY_BYTES, _DEFAULT_REKEY_SECONDS, _DEFAULT_PORT
 
+from jsshd.logger import logger
+
 from .connection import InternalFakeSSHClientConnection
+from .cache import FileCache, file_paths, _DEFAULT_CHECK_INTERVAL
+
+
+_DEFAULT_KEY_FILES = ('id_ed25519', 'id_ecdsa', 'id_rsa', 'id_dsa')
 
 
 
@@ -15,8 +23,34 @@ class __FakeInternalClient(SSHClient): pass
 
 
 class FakeSSHClientConnection(InternalFakeSSHClientConnection):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, defer_auth=False, **kwargs):
         super(FakeSSHClientConnection, self).__init__(*args, **kwargs)
+        self.__auth_future = self._auth_waiter
+        self.__defer_auth = defer_auth
+        self.__auth_ready = False
+
+        # nobody may wait for a speculative connection which is dropped before auth
+        if defer_auth: self.__auth_future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+    def try_next_auth(self):
+        # hold the first auth request until start_auth() gives the username
+        if self.__defer_auth:
+            self.__auth_ready = True
+            return
+        return super(FakeSSHClientConnection, self).try_next_auth()
+
+
+    async def start_auth(self, username):
+        """Authenticate a connection created with defer_auth as username and wait until it succeeds"""
+        self._username = saslprep(username)
+        self.timestamps['auth_started'] = self._loop.time()
+
+        if self.__defer_auth:
+            self.__defer_auth = False
+            if self.__auth_ready: self.try_next_auth()
+
+        await self.__auth_future
 
     def send_packet(self, pkttype, *args, handler=None):
         #print('DST SEND {}'.format(pkttype))
@@ -29,6 +63,143 @@ class FakeSSHClientConnection(InternalFakeSSHClientConnection):
 
 
 
+class ClientProfile(object):
+    """Credential bundle (keypairs, trusted certs, validated algorithms) shared by every fake client"""
+
+    def __init__(self, client_keys=(), passphrase=None, client_host_keysign=False,
+                 client_host_keys=None, x509_trusted_certs=(), x509_trusted_cert_paths=(),
+                 client_version=(), kex_algs=(), encryption_algs=(), mac_algs=(),
+                 compression_algs=(), signature_algs=()):
+
+        ssh_dir = os.path.join(os.path.expanduser('~'), '.ssh')
+        self.paths = file_paths(client_keys) + file_paths(client_host_keys)
+
+        self.client_version = _validate_version(client_version)
+
+        self.kex_algs, self.encryption_algs, self.mac_algs, self.compression_algs, self.signature_algs = \
+            _validate_algs(kex_algs, encryption_algs, mac_algs, compression_algs,
+                           signature_algs, x509_trusted_certs is not None)
+
+        if x509_trusted_certs == ():
+            path = os.path.join(ssh_dir, 'ca-bundle.crt')
+            self.paths.append(path)
+            try:
+                x509_trusted_certs = load_certificates(path)
+            except OSError:
+                pass
+        elif x509_trusted_certs is not None:
+            self.paths += file_paths(x509_trusted_certs)
+            x509_trusted_certs = load_certificates(x509_trusted_certs)
+        self.x509_trusted_certs = x509_trusted_certs
+
+        if x509_trusted_cert_paths == ():
+            path = os.path.join(ssh_dir, 'crt')
+            self.paths.append(path)
+            if os.path.isdir(path):
+                x509_trusted_cert_paths = [path]
+        elif x509_trusted_cert_paths:
+            for path in x509_trusted_cert_paths:
+                if not os.path.isdir(path):
+                    raise ValueError('Path not a directory: ' + str(path))
+        self.x509_trusted_cert_paths = x509_trusted_cert_paths
+
+        self.client_host_keysign = client_host_keysign
+        if client_host_keysign:
+            self.client_host_keysign = find_keysign(client_host_keysign)
+
+            if client_host_keys:
+                self.client_host_keys = load_public_keys(client_host_keys)
+            else:
+                self.client_host_keys = load_default_host_public_keys()
+        else:
+            self.client_host_keys = load_keypairs(client_host_keys, passphrase)
+
+        if client_keys:
+            self.client_keys = load_keypairs(client_keys, passphrase)
+            self.default_keys = None
+        else:
+            self.client_keys = client_keys
+            self.default_keys = load_default_keypairs(passphrase) if client_keys == () else None
+            if client_keys == (): self.paths += [os.path.join(ssh_dir, f) for f in _DEFAULT_KEY_FILES]
+
+
+
+# seconds a missing or failing agent is remembered before connecting again
+_AGENT_RETRY_INTERVAL = 5.0
+
+
+class _AgentKeys(object):
+    """One long-lived ssh-agent connection per agent path and the keys it holds"""
+
+    def __init__(self, check_interval=_DEFAULT_CHECK_INTERVAL, retry_interval=_AGENT_RETRY_INTERVAL):
+        self.__check_interval = check_interval
+        self.__retry_interval = retry_interval
+        self.__entries = {}
+
+    async def get(self, agent_path, loop):
+        entry = self.__entries.get(agent_path, None)
+        if entry is None or (entry[0] is None and time.monotonic() - entry[2] > self.__retry_interval):
+            entry = await self.__connect(agent_path, loop)
+            self.__entries[agent_path] = entry
+
+        elif entry[0] is not None and not entry[3] and time.monotonic() - entry[2] > self.__check_interval:
+            entry[3] = True
+            loop.create_task(self.__refresh(agent_path, entry, loop))
+
+        return entry[1]
+
+    def close(self):
+        for agent, *_ in self.__entries.values():
+            if agent: agent.close()
+        self.__entries.clear()
+
+    async def __connect(self, agent_path, loop):
+        # a failed entry has no agent, get() retries it after retry_interval
+        agent = None
+        try:
+            agent = await connect_agent(agent_path, loop=loop)
+            if agent: return [agent, await agent.get_keys(), time.monotonic(), False]
+        except Exception as e:
+            logger.warning('ssh-agent {} failed: {}'.format(agent_path, e))
+            if agent: agent.close()
+        return [None, [], time.monotonic(), False]
+
+    async def __refresh(self, agent_path, entry, loop):
+        try:
+            entry[1] = await entry[0].get_keys() if entry[0] else []
+            entry[2] = time.monotonic()
+        except Exception:
+            # agent went away, reconnect on the next lookup
+            if entry[0]: entry[0].close()
+            self.__entries.pop(agent_path, None)
+        finally:
+            entry[3] = False
+
+
+
+_PROFILES = FileCache(ClientProfile)
+
+_AGENTS = _AgentKeys()
+
+
+def build_profile(client_keys=(), passphrase=None, client_host_keysign=False,
+                  client_host_keys=None, x509_trusted_certs=(), x509_trusted_cert_paths=(),
+                  client_version=(), kex_algs=(), encryption_algs=(), mac_algs=(),
+                  compression_algs=(), signature_algs=()):
+    """Build the client credential bundle so upstream connects never touch the disk, see install_profiles"""
+    return _PROFILES.build(client_keys, passphrase, client_host_keysign, client_host_keys,
+                           x509_trusted_certs, x509_trusted_cert_paths, client_version,
+                           kex_algs, encryption_algs, mac_algs, compression_algs, signature_algs)
+
+
+def install_profiles(*profiles): _PROFILES.replace(*profiles)
+
+
+@functools.lru_cache(maxsize=1)
+def _default_username(): return getpass.getuser()
+
+
+
 @asyncio.coroutine
 def create_connection(client_factory=None, host=None, port=_DEFAULT_PORT, *,
                       loop=None, tunnel=None, family=0, flags=0,
@@ -44,7 +215,7 @@ def create_connection(client_factory=None, host=None, port=_DEFAULT_PORT, *,
                       mac_algs=(), compression_algs=(), signature_algs=(),
                       rekey_bytes=_DEFAULT_REKEY_BYTES,
                       rekey_seconds=_DEFAULT_REKEY_SECONDS,
-                      connection_wrapper=None):
+                      connection_wrapper=None, connect_addrs=None, defer_auth=False):
 
 
 
@@ -61,8 +232,8 @@ def create_connection(client_factory=None, host=None, port=_DEFAULT_PORT, *,
                                    known_hosts, username, password,
                                    client_host_keysign, client_host_keys,
                                    client_host, client_username, client_keys,
-                                   gss_host, gss_delegate_creds, agent,
-                                   agent_path, auth_waiter)
+                                   gss_host, gss_delegate_creds, None,
+                                   agent_path, auth_waiter, defer_auth=defer_auth)
 
         return conn if connection_wrapper is None else connection_wrapper(conn)
 
@@ -72,103 +243,82 @@ def create_connection(client_factory=None, host=None, port=_DEFAULT_PORT, *,
     if not loop:
         loop = asyncio.get_event_loop()
 
-    client_version = _validate_version(client_version)
+    profile = yield from _PROFILES.get(client_keys, passphrase, client_host_keysign, client_host_keys,
+                                       x509_trusted_certs, x509_trusted_cert_paths, client_version,
+                                       kex_algs, encryption_algs, mac_algs, compression_algs,
+                                       signature_algs, loop=loop)
 
+    client_version = profile.client_version
     kex_algs, encryption_algs, mac_algs, compression_algs, signature_algs = \
-        _validate_algs(kex_algs, encryption_algs, mac_algs, compression_algs,
-                       signature_algs, x509_trusted_certs is not None)
-
-    if x509_trusted_certs == ():
-        try:
-            x509_trusted_certs = load_certificates(
-                os.path.join(os.path.expanduser('~'), '.ssh', 'ca-bundle.crt'))
-        except OSError:
-            pass
-    elif x509_trusted_certs is not None:
-        x509_trusted_certs = load_certificates(x509_trusted_certs)
-
-    if x509_trusted_cert_paths == ():
-        path = os.path.join(os.path.expanduser('~'), '.ssh', 'crt')
-        if os.path.isdir(path):
-            x509_trusted_cert_paths = [path]
-    elif x509_trusted_cert_paths:
-        for path in x509_trusted_cert_paths:
-            if not os.path.isdir(path):
-                raise ValueError('Path not a directory: ' + str(path))
+        profile.kex_algs, profile.encryption_algs, profile.mac_algs, \
+        profile.compression_algs, profile.signature_algs
+    x509_trusted_certs = profile.x509_trusted_certs
+    x509_trusted_cert_paths = profile.x509_trusted_cert_paths
+    client_host_keysign = profile.client_host_keysign
+    client_host_keys = profile.client_host_keys
 
     if username is None:
-        username = getpass.getuser()
+        username = _default_username()
 
     username = saslprep(username)
 
-    if client_host_keysign:
-        client_host_keysign = find_keysign(client_host_keysign)
-
-        if client_host_keys:
-            client_host_keys = load_public_keys(client_host_keys)
-        else:
-            client_host_keys = load_default_host_public_keys()
-    else:
-        client_host_keys = load_keypairs(client_host_keys, passphrase)
-
     if client_username is None:
-        client_username = getpass.getuser()
+        client_username = _default_username()
 
     client_username = saslprep(client_username)
 
     if gss_host == ():
         gss_host = host
 
-    agent = None
-
     if agent_path == ():
         agent_path = os.environ.get('SSH_AUTH_SOCK', None)
 
-    if client_keys:
-        client_keys = load_keypairs(client_keys, passphrase)
-    elif client_keys == ():
-        if agent_path:
-            agent = yield from connect_agent(agent_path, loop=loop)
-
-            if agent:
-                client_keys = yield from agent.get_keys()
-            else:
-                agent_path = None
-
+    # the shared agent connection is owned by _AGENTS, so it is never handed to the connection
+    if client_keys == ():
+        client_keys = (yield from _AGENTS.get(agent_path, loop)) if agent_path else []
         if not client_keys:
-            client_keys = load_default_keypairs(passphrase)
+            client_keys = profile.default_keys
+    else:
+        client_keys = profile.client_keys
+
+    # asyncssh pops the keys it tries, the cached lists are shared by every connection
+    client_keys = list(client_keys or ())
+    client_host_keys = list(client_host_keys or ())
 
     if not agent_forwarding:
         agent_path = None
 
     auth_waiter = asyncio.Future(loop=loop)
 
-    # pylint: disable=broad-except
-    try:
-        if tunnel:
-            #tunnel_logger = getattr(tunnel, 'logger', logger)
-            #tunnel_logger.info('Opening SSH tunnel to %s', (host, port))
-            _, conn = yield from tunnel.create_connection(conn_factory, host,
-                                                          port)
-        else:
-            #logger.info('Opening SSH connection to %s', (host, port))
-            _, conn = yield from loop.create_connection(conn_factory, host,
-                                                        port, family=family,
-                                                        flags=flags,
-                                                        local_addr=local_addr)
-    except Exception:
-        if agent:
-            agent.close()
-
-        raise
+    if tunnel:
+        #tunnel_logger = getattr(tunnel, 'logger', logger)
+        #tunnel_logger.info('Opening SSH tunnel to %s', (host, port))
+        _, conn = yield from tunnel.create_connection(conn_factory, host,
+                                                      port)
+    elif connect_addrs:
+        # getaddrinfo() results of host, tried in order like loop.create_connection does
+        for i, (addr_family, _, _, _, sockaddr) in enumerate(connect_addrs):
+            try:
+                _, conn = yield from loop.create_connection(conn_factory, sockaddr[0], sockaddr[1],
+                                                            family=addr_family, local_addr=local_addr)
+                break
+            except OSError:
+                if i == len(connect_addrs) - 1: raise
+    else:
+        #logger.info('Opening SSH connection to %s', (host, port))
+        _, conn = yield from loop.create_connection(conn_factory, host,
+                                                    port, family=family,
+                                                    flags=flags,
+                                                    local_addr=local_addr)
 
-    yield from auth_waiter
+    # with defer_auth the caller finishes the login through conn.start_auth(username)
+    if not defer_auth:
+        yield from auth_waiter
 
     return conn
 
 
 
-
 if __name__ == '__main__':
 
     async def main():
@@ -1,11 +1,64 @@
 
-from asyncssh.packet import PacketDecodeError, SSHPacket, UInt32
+import os
+import time
+
+from asyncssh.packet import PacketDecodeError, SSHPacket, Byte, String, UInt32
 from asyncssh.constants import *
 from asyncssh.misc import  DisconnectError
 from asyncssh.connection import SSHConnection, SSHServerConnection, SSHClientConnection
 from asyncssh.gss import GSSServer, GSSClient, GSSError
 
 from pyplus.framework import Messager
+from pyplus.collection import qdict
+
+from .buffer import InputBuffer
+
+
+# uncompressed bytes sent between two checks of the compression ratio
+_COMPRESSION_SAMPLE = 1024 * 1024
+
+
+class _MeasuredCompressor(object):
+    """Compressor adding to stats [raw, compressed, seconds] and passing each sample's sizes to check"""
+
+    def __init__(self, compressor, stats, check=None):
+        self.__compressor = compressor
+        self.__stats = stats
+        self.__check = check
+        self.__raw = self.__compressed = 0
+
+    def compress(self, data):
+        start = time.perf_counter()
+        result = self.__compressor.compress(data)
+        stats = self.__stats
+        stats[2] += time.perf_counter() - start
+        stats[0] += len(data)
+        stats[1] += len(result)
+
+        if self.__check is not None:
+            self.__raw += len(data)
+            self.__compressed += len(result)
+            if self.__raw >= _COMPRESSION_SAMPLE:
+                self.__check(self.__raw, self.__compressed)
+                self.__raw = self.__compressed = 0
+        return result
+
+
+class _MeasuredDecompressor(object):
+    def __init__(self, decompressor, stats):
+        self.__decompressor = decompressor
+        self.__stats = stats
+
+    def decompress(self, data):
+        start = time.perf_counter()
+        result = self.__decompressor.decompress(data)
+        stats = self.__stats
+        stats[2] += time.perf_counter() - start
+        stats[0] += len(result)
+        stats[1] += len(data)
+        return result
+
+
 
 class FakeSSHConnection(SSHConnection, Messager):
 
@@ -13,31 +66,182 @@ class FakeSSHConnection(SSHConnection, Messager):
         SSHConnection.__init__(self, *args, **kwargs)
         Messager.__init__(self)
 
+        # log to asyncssh.fake so that the bridges' packets get their own level
+        self._logger = self._logger.get_child('fake')
+
         self.__process_packet_callback = None
 
+        # packet types relayed as raw payloads once authenticated, see set_redirect
+        self._redirect_types = frozenset()
+        self._redirect_callback = None
+
+        # encrypted packets waiting for the end of this loop iteration, see _send
+        self._send_queue = []
+        self._write_stats = qdict(batches=0, packets=0, bytes=0, max_batch=0)
+
+        # flow control, see set_write_buffer_limits
+        self._write_limits = None
+        self._max_buffer_size = None
+        self._write_paused = False
+        self._read_paused = False
+
+        # loop time of connection_made and of the first completed key exchange
+        self.timestamps = {}
+
+        # sampled packet tracing, see jsshd.trace
+        self.tracer = None
+        self.trace_id = None
+
+        # compression stats and adaptive disabling, see set_compression
+        self._compression = None
+        self._compression_algs = None
+        self._compression_timer = None
+
+    @property
+    def write_stats(self): return self._write_stats
+
     @property
     def process_packet_callback(self): return self.__process_packet_callback
 
     @process_packet_callback.setter
     def process_packet_callback(self, v): self.__process_packet_callback = v
 
+
+    def set_redirect(self, callback, pkttypes=()):
+        """
+        Hand decrypted payloads of pkttypes straight to callback(pkttype, payload) once the
+        connection is authenticated, skipping SSHPacket, logging and process_packet.
+        """
+        self._redirect_callback = callback
+        self._redirect_types = frozenset(t for t in pkttypes if t > MSG_USERAUTH_LAST) if callback else frozenset()
+
+    def set_compression(self, stats, disable_ratio=0, retry_interval=0, timers=None):
+        """
+        Count compression into stats, a qdict of send and recv [raw, compressed, seconds] lists and
+        a disabled count. With a disable_ratio, compression is renegotiated to none by a key
+        re-exchange once sent data compresses worse than that, and offered again after
+        retry_interval seconds (never if 0), scheduled on timers or the loop. SSH compresses the
+        whole connection, not channels.
+        """
+        self._compression = (stats, disable_ratio, retry_interval, timers or self._loop)
+
+
+    def __check_compression(self, raw, compressed):
+        stats, ratio, retry, timers = self._compression
+        if compressed < raw * ratio or self._compression_algs is not None: return
+
+        self.logger.info('Compression ratio %.2f above %.2f, disabling compression', compressed / raw, ratio)
+        stats.disabled += 1
+        self._compression_algs, self._cmp_algs = self._cmp_algs, [b'none']
+        self._rekey_time = 0
+        if retry: self._compression_timer = timers.call_later(retry, self.__enable_compression)
+
+
+    def __enable_compression(self):
+        self._compression_timer = None
+        algs, self._compression_algs = self._compression_algs, None
+        if not self._transport or algs is None: return
+        self._cmp_algs = algs
+        self._rekey_time = 0
+
+
+    @property
+    def write_paused(self): return self._write_paused
+
+    @property
+    def read_paused(self): return self._read_paused
+
+
+    def set_write_buffer_limits(self, high=None, low=None, max_size=None):
+        """Watermarks of the transport and the buffered size at which the connection is aborted"""
+        self._write_limits = (high, low)
+        self._max_buffer_size = max_size
+        self._apply_write_buffer_limits()
+
+    def _apply_write_buffer_limits(self):
+        if self._transport and self._write_limits:
+            self._transport.set_write_buffer_limits(*self._write_limits)
+
+
+    def pause_reading(self):
+        if self._read_paused or not self._transport: return
+        self._read_paused = True
+        self._transport.pause_reading()
+
+    def resume_reading(self):
+        if not self._read_paused or not self._transport: return
+        self._read_paused = False
+        self._transport.resume_reading()
+
+
     def connection_made(self, transport):
+        self.timestamps['connection_made'] = self._loop.time()
         super(FakeSSHConnection, self).connection_made(transport)
+        self._apply_write_buffer_limits()
         self.notify('connection_made', transport)
 
     def connection_lost(self, exc):
+        if self._compression_timer is not None:
+            self._compression_timer.cancel()
+            self._compression_timer = None
         super(FakeSSHConnection, self).connection_lost(exc)
         self.notify('connection_lost', exc)
 
     def pause_writing(self):
         super(FakeSSHConnection, self).pause_writing()
+        self._write_paused = True
         self.notify('pause_writing')
 
     def resume_writing(self, *args, **kwargs):
         super(FakeSSHConnection, self).resume_writing()
+        self._write_paused = False
         self.notify('resume_writing')
 
 
+    def _send(self, data):
+        """Queue data and write everything sent in this loop iteration with one writelines call"""
+
+        if not self._transport or self._transport.is_closing(): return
+
+        if not self._send_queue:
+            self._loop.call_soon(self._flush_send_queue)
+
+        self._send_queue.append(data)
+
+
+    def _flush_send_queue(self):
+        queue, self._send_queue = self._send_queue, []
+        if not queue or not self._transport or self._transport.is_closing(): return
+
+        # this runs as a loop callback, write errors (e.g. of a closed tunnel channel) have to
+        # close the connection here instead of reaching asyncssh's packet handling
+        try:
+            if len(queue) == 1:
+                self._transport.write(queue[0])
+            else:
+                self._transport.writelines(queue)
+        except Exception as exc:
+            self._force_close(exc)
+            return
+
+        stats = self._write_stats
+        stats.batches += 1
+        stats.packets += len(queue)
+        stats.bytes += sum(map(len, queue))
+        if len(queue) > stats.max_batch: stats.max_batch = len(queue)
+
+        # the peer keeps producing until its reading is paused, cap what may pile up meanwhile
+        if self._write_paused and self._max_buffer_size and \
+                self._transport.get_write_buffer_size() > self._max_buffer_size:
+            self._force_close(DisconnectError(DISC_BY_APPLICATION, 'Write buffer limit exceeded'))
+
+
+    def _force_close(self, exc):
+        # a pending disconnect message has to reach the transport before it is aborted
+        self._flush_send_queue()
+        super(FakeSSHConnection, self)._force_close(exc)
+
+
     def process_packet(self, pkttype, pktid, packet):
         """Log and process a received packet"""
 
@@ -48,10 +252,149 @@ class FakeSSHConnection(SSHConnection, Messager):
         return SSHConnection.process_packet(self, pkttype, pktid, packet)
 
 
+    def send_newkeys(self, k, h):
+        super(FakeSSHConnection, self).send_newkeys(k, h)
+        self.timestamps.setdefault('kex_complete', self._loop.time())
+
+        if self._compression is not None:
+            stats, ratio, _, _ = self._compression
+            if self._compressor is not None:
+                self._compressor = _MeasuredCompressor(self._compressor, stats.send,
+                                                       self.__check_compression if ratio else None)
+            if self._next_decompressor is not None:
+                self._next_decompressor = _MeasuredDecompressor(self._next_decompressor, stats.recv)
+
+
     def raw_process_packet(self, pkttype, pktid, packet):
         return SSHConnection.process_packet(self, pkttype, pktid, packet)
 
 
+    def send_packet(self, pkttype, *args, handler=None):
+        if self.tracer is not None: self.tracer.record(self.trace_id, 'send', pkttype, 1 + sum(map(len, args)))
+        return SSHConnection.send_packet(self, pkttype, *args, handler=handler)
+
+
+    def send_payload(self, payload):
+        """Send an already encoded packet payload (type byte included) without logging it"""
+
+        pkttype = payload[0]
+        if self.tracer is not None: self.tracer.record(self.trace_id, 'send', pkttype, len(payload))
+
+        if (self._auth_complete and self._kex_complete and
+                (self._rekey_bytes_sent >= self._rekey_bytes or
+                 time.monotonic() >= self._rekey_time)):
+            self._send_kexinit()
+            self._kexinit_sent = True
+
+        if not (self._kex_complete and self._auth_complete):
+            self._deferred_packets.append((pkttype, (payload[1:],)))
+            return
+
+        # If we're encrypting and we have no data outstanding, insert an
+        # ignore packet into the stream
+        if self._send_encryption:
+            self.send_packet(MSG_IGNORE, String(b''))
+
+        if self._compressor and (self._auth_complete or
+                                 not self._compress_after_auth):
+            payload = self._compressor.compress(payload)
+
+        padlen = -(self._send_enchdrlen + len(payload)) % self._send_blocksize
+        if padlen < 4:
+            padlen += self._send_blocksize
+
+        packet = Byte(padlen) + payload + os.urandom(padlen)
+        pktlen = len(packet)
+        hdr = UInt32(pktlen)
+        seq = self._send_seq
+
+        if self._send_encryption:
+            packet, mac = self._send_encryption.encrypt_packet(seq, hdr, packet)
+        else:
+            packet = hdr + packet
+            mac = b''
+
+        self._send(packet + mac)
+        self._send_seq = (seq + 1) & 0xffffffff
+        self._rekey_bytes_sent += pktlen
+
+
+
+    def data_received(self, data, datatype=None):
+        """Handle incoming data on the connection"""
+
+        # asyncssh resets _inpbuf to b'' on init and cleanup
+        if self._inpbuf.__class__ is not InputBuffer:
+            self._inpbuf = InputBuffer(self._inpbuf)
+
+        self._inpbuf.append(data)
+
+        # pylint: disable=broad-except
+        try:
+            while self._inpbuf and self._recv_handler():
+                pass
+        except DisconnectError as exc:
+            self._send_disconnect(exc.code, exc.reason, exc.lang)
+            self._force_close(exc)
+        except Exception:
+            self.internal_error()
+
+
+    def _recv_version(self):
+        """Receive and parse the remote SSH version"""
+
+        idx = self._inpbuf.find(b'\n')
+        if idx < 0:
+            return False
+
+        version = self._inpbuf.read(idx+1)[:-1]
+        if version.endswith(b'\r'):
+            version = version[:-1]
+
+        if (version.startswith(b'SSH-2.0-') or
+                (self.is_client() and version.startswith(b'SSH-1.99-'))):
+            # Accept version 2.0, or 1.99 if we're a client
+            if self.is_server():
+                self._client_version = version
+                self._extra.update(client_version=version.decode('ascii'))
+            else:
+                self._server_version = version
+                self._extra.update(server_version=version.decode('ascii'))
+
+            self._send_kexinit()
+            self._kexinit_sent = True
+            self._recv_handler = self._recv_pkthdr
+        elif self.is_client() and not version.startswith(b'SSH-'):
+            # As a client, ignore the line if it doesn't appear to be a version
+            pass
+        else:
+            # Otherwise, reject the unknown version
+            self._force_close(DisconnectError(DISC_PROTOCOL_ERROR,
+                                              'Unknown SSH version'))
+            return False
+
+        return True
+
+
+    def _recv_pkthdr(self):
+        """Receive and parse an SSH packet header"""
+
+        if len(self._inpbuf) < self._recv_blocksize:
+            return False
+
+        self._packet = self._inpbuf.read(self._recv_blocksize)
+
+        if self._recv_encryption:
+            self._packet, pktlen = \
+                self._recv_encryption.decrypt_header(self._recv_seq,
+                                                     self._packet, 4)
+        else:
+            pktlen = self._packet[:4]
+
+        self._pktlen = int.from_bytes(pktlen, 'big')
+        self._recv_handler = self._recv_packet
+        return True
+
 
     def _recv_packet(self):
         """Receive the remainder of an SSH packet and process it"""
@@ -61,8 +404,8 @@ class FakeSSHConnection(SSHConnection, Messager):
             return False
 
         seq = self._recv_seq
-        rest = self._inpbuf[:rem-self._recv_macsize]
-        mac = self._inpbuf[rem-self._recv_macsize:rem]
+        rest = self._inpbuf.peek(rem-self._recv_macsize)
+        mac = self._inpbuf.peek(self._recv_macsize, rem-self._recv_macsize)
 
         if self._recv_encryption:
             packet = self._recv_encryption.decrypt_packet(seq, self._packet,
@@ -73,7 +416,7 @@ class FakeSSHConnection(SSHConnection, Messager):
         else:
             packet = self._packet[4:] + rest
 
-        self._inpbuf = self._inpbuf[rem:]
+        self._inpbuf.consume(rem)
         self._packet = b''
 
         payload = packet[1:-packet[0]]
@@ -82,6 +425,17 @@ class FakeSSHConnection(SSHConnection, Messager):
                                    not self._decompress_after_auth):
             payload = self._decompressor.decompress(payload)
 
+        if self.tracer is not None: self.tracer.record(self.trace_id, 'recv', payload[0], len(payload))
+
+        if payload[0] in self._redirect_types and self._auth_complete:
+            self._redirect_callback(payload[0], payload)
+
+            if self._transport:
+                self._recv_seq = (seq + 1) & 0xffffffff
+                self._recv_handler = self._recv_pkthdr
+
+            return True
+
         packet = SSHPacket(payload)
         pkttype = packet.get_byte()
         handler = self
@@ -0,0 +1,19 @@
+from asyncssh import constants
+
+
+def _packet_names():
+    names, seen = {}, set()
+    for k, v in vars(constants).items():
+        if not k.startswith('MSG_') or not isinstance(v, int) or k.endswith(('_FIRST', '_LAST')): continue
+        # numbers shared by several messages, like the kex and userauth method ones, stay numbers
+        if v in seen: names.pop(v, None)
+        else: names[v] = k
+        seen.add(v)
+    return names
+
+_PACKET_NAMES = _packet_names()
+
+
+def packet_name(pkttype):
+    """Name of the SSH message number pkttype, the number itself if it is unknown or ambiguous"""
+    return _PACKET_NAMES.get(pkttype, pkttype)
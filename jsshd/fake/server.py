@@ -1,6 +1,7 @@
 import sys
 import socket
 import asyncio
+import functools
 from collections import OrderedDict
 
 from asyncssh import SSHServer, SFTPServer
@@ -14,6 +15,7 @@ from asyncssh.public_key import load_keypairs
 from asyncssh.misc import DisconnectError
 
 from .connection import InternalFakeSSHServerConnection
+from .cache import FileCache, file_paths
 
 
 class __InternalFakeSSHServer(SSHServer):
@@ -45,6 +47,19 @@ class TransportWrapper(object):
     def write(self, *args, **kwargs):
         return self.__chan.write(*args, **kwargs)
 
+    def writelines(self, list_of_data):
+        return self.__chan.write(b''.join(list_of_data))
+
+    def is_closing(self): return self.__chan._send_state != 'open'
+
+    def get_write_buffer_size(self): return self.__chan.get_write_buffer_size()
+
+    def set_write_buffer_limits(self, high=None, low=None): return self.__chan.set_write_buffer_limits(high, low)
+
+    def pause_reading(self): return self.__chan.pause_reading()
+
+    def resume_reading(self): return self.__chan.resume_reading()
+
     def abort(self):
         self.__conn.close()
 
@@ -60,7 +75,9 @@ class FakeSSHServerConnection(InternalFakeSSHServerConnection):
 
 
     def connection_made(self, transport, *args, **kwargs):
+        self.timestamps['connection_made'] = self._loop.time()
         self._transport = TransportWrapper(transport)
+        self._apply_write_buffer_limits()
 
         sockname = transport.get_extra_info('sockname')
         self._local_addr, self._local_port = sockname[:2]
@@ -89,6 +106,60 @@ class FakeSSHServerConnection(InternalFakeSSHServerConnection):
 
 
 
+class ServerProfile(object):
+    """Parsed host keys, validated algorithms and certificates shared by every fake server"""
+
+    def __init__(self, server_host_keys, passphrase=None, server_version=(),
+                 kex_algs=(), encryption_algs=(), mac_algs=(), compression_algs=(),
+                 signature_algs=(), x509_trusted_certs=()):
+
+        self.paths = file_paths(server_host_keys)
+        if isinstance(x509_trusted_certs, (str, list, tuple)): self.paths += file_paths(x509_trusted_certs)
+
+        self.server_version = _validate_version(server_version)
+
+        self.kex_algs, self.encryption_algs, self.mac_algs, self.compression_algs, self.signature_algs = \
+            _validate_algs(kex_algs, encryption_algs, mac_algs, compression_algs,
+                           signature_algs, x509_trusted_certs is not None)
+
+        self.server_keys = load_keypairs(server_host_keys, passphrase)
+
+        self.server_host_keys = OrderedDict()
+
+        for keypair in self.server_keys:
+            for alg in keypair.host_key_algorithms:
+                if alg in self.server_host_keys:
+                    raise ValueError('Multiple keys of type %s found' %
+                                     alg.decode('ascii'))
+
+                self.server_host_keys[alg] = keypair
+
+        self.x509_trusted_certs = None if x509_trusted_certs is None else load_certificates(x509_trusted_certs)
+
+
+
+_PROFILES = FileCache(ServerProfile)
+
+
+@functools.lru_cache(maxsize=1)
+def _default_gss_host():
+    gss_host = socket.gethostname()
+    return gss_host if '.' in gss_host else socket.getfqdn()
+
+
+def build_profile(server_host_keys, passphrase=None, server_version=(),
+                  kex_algs=(), encryption_algs=(), mac_algs=(), compression_algs=(),
+                  signature_algs=(), x509_trusted_certs=()):
+    """Build the server profile so the first bridge does not pay for it, see install_profiles"""
+    return _PROFILES.build(server_host_keys, passphrase, server_version,
+                           kex_algs, encryption_algs, mac_algs, compression_algs,
+                           signature_algs, x509_trusted_certs)
+
+
+def install_profiles(*profiles): _PROFILES.replace(*profiles)
+
+
+
 @asyncio.coroutine
 def create_connection(server_factory=None, *,
                       loop=None,  server_host_keys=None, passphrase=None,
@@ -122,38 +193,27 @@ def create_connection(server_factory=None, *,
     if not loop:
         loop = asyncio.get_event_loop()
 
-    server_version = _validate_version(server_version)
-
     if gss_host == ():
-        gss_host = socket.gethostname()
+        gss_host = _default_gss_host()
 
-        if '.' not in gss_host:
-            gss_host = socket.getfqdn()
+    profile = yield from _PROFILES.get(server_host_keys, passphrase, server_version,
+                                       kex_algs, encryption_algs, mac_algs, compression_algs,
+                                       signature_algs, x509_trusted_certs, loop=loop)
 
+    server_version = profile.server_version
     kex_algs, encryption_algs, mac_algs, compression_algs, signature_algs = \
-        _validate_algs(kex_algs, encryption_algs, mac_algs, compression_algs,
-                       signature_algs, x509_trusted_certs is not None)
+        profile.kex_algs, profile.encryption_algs, profile.mac_algs, \
+        profile.compression_algs, profile.signature_algs
 
-    server_keys = load_keypairs(server_host_keys, passphrase)
-
-    if not server_keys and not gss_host:
+    if not profile.server_keys and not gss_host:
         raise ValueError('No server host keys provided')
 
-    server_host_keys = OrderedDict()
-
-    for keypair in server_keys:
-        for alg in keypair.host_key_algorithms:
-            if alg in server_host_keys:
-                raise ValueError('Multiple keys of type %s found' %
-                                 alg.decode('ascii'))
-
-            server_host_keys[alg] = keypair
+    server_host_keys = profile.server_host_keys
 
     if isinstance(authorized_client_keys, str):
         authorized_client_keys = read_authorized_keys(authorized_client_keys)
 
-    if x509_trusted_certs is not None:
-        x509_trusted_certs = load_certificates(x509_trusted_certs)
+    x509_trusted_certs = profile.x509_trusted_certs
 
     conn = FakeSSHServerConnection(server_factory, loop, server_version,
                                 x509_trusted_certs, x509_trusted_cert_paths,
@@ -0,0 +1,135 @@
+import os
+import time
+import asyncio
+import sqlite3
+
+from asyncssh.auth_keys import _SSHAuthorizedKeyEntry
+from asyncssh.public_key import KeyImportError
+
+from jsshd.logger import logger
+from jsshd.fake.cache import _mtime, _DEFAULT_CHECK_INTERVAL
+
+
+def _parse(username, lines):
+    """Yield (public key data, (username, entry)) of the key entries of authorized_keys lines"""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'): continue
+        try:
+            entry = _SSHAuthorizedKeyEntry(line)
+        except (KeyImportError, ValueError) as e:
+            logger.warning('skip authorized key of {}: {}'.format(username, e))
+            continue
+        if entry.key is None or 'cert-authority' in entry.options: continue
+        yield entry.key.public_data, (username, entry)
+
+
+
+class KeyStore(object):
+    """
+    Authorized keys of every user indexed by public key data, so that a lookup is one dict access.
+
+    Keys come from a directory holding one authorized_keys style file per user, named after the
+    user, and/or from a SQLite table authorized_keys(username, key) whose key column holds
+    authorized_keys lines. Options such as from= and permitopen= are kept. Once loaded, sources
+    are checked for mtime changes every check_interval seconds in the default executor and only
+    the changed ones are parsed again.
+    """
+
+    def __init__(self, directory=None, database=None, check_interval=_DEFAULT_CHECK_INTERVAL):
+        self.__directory = directory
+        self.__database = database
+        self.__check_interval = check_interval
+        self.__index = {}           # public data -> [(source, username, entry), ...]
+        self.__sources = {}         # source -> (mtime, [public data, ...])
+        self.__checked_at = 0.0
+        self.__refreshing = False
+
+
+    def __len__(self): return len(self.__index)
+
+
+    def load(self):
+        """Read every source, may run in an executor while the store is not used yet"""
+        self.__apply(self.__scan())
+        self.__checked_at = time.monotonic()
+        return self
+
+
+    def validate(self, username, key, client_addr):
+        """Return the authorized_keys options of key for username, or None if it is not authorized"""
+        self.__check()
+        for _, name, entry in self.__index.get(key.public_data, ()):
+            if name == username and entry.match_options(client_addr, None): return entry.options
+        return None
+
+
+    def __check(self):
+        if self.__refreshing or time.monotonic() - self.__checked_at < self.__check_interval: return
+        self.__refreshing = True
+        asyncio.get_event_loop().create_task(self.__refresh())
+
+
+    async def __refresh(self):
+        try:
+            changes = await asyncio.get_event_loop().run_in_executor(None, self.__scan)
+            if changes:
+                self.__apply(changes)
+                logger.info('authorized keys reloaded from {} sources, {} keys'.format(len(changes), len(self)))
+        except Exception as e:
+            logger.warning('refresh authorized keys failed: {}'.format(e))
+        finally:
+            self.__checked_at = time.monotonic()
+            self.__refreshing = False
+
+
+    def __scan(self):
+        """Return {source: (mtime, [(public data, (username, entry)), ...]) or None if removed} of changed sources"""
+        changes = {}
+        seen = set()
+
+        if self.__directory:
+            for name in os.listdir(self.__directory):
+                path = os.path.join(self.__directory, name)
+                if name.startswith('.') or not os.path.isfile(path): continue
+                seen.add(path)
+
+                mtime = _mtime(path)
+                if path in self.__sources and self.__sources[path][0] == mtime: continue
+                with open(path, encoding='utf-8') as f:
+                    changes[path] = (mtime, list(_parse(name, f)))
+
+        if self.__database:
+            path = self.__database
+            seen.add(path)
+
+            mtime = (_mtime(path), _mtime(path + '-wal'))
+            if path not in self.__sources or self.__sources[path][0] != mtime:
+                db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+                try:
+                    rows = db.execute('SELECT username, key FROM authorized_keys').fetchall()
+                finally:
+                    db.close()
+                changes[path] = (mtime, [k for username, key in rows for k in _parse(username, (key,))])
+
+        for source in self.__sources:
+            if source not in seen: changes[source] = None
+
+        return changes
+
+
+    def __apply(self, changes):
+        for source, change in changes.items():
+            # drop the previous entries of source
+            _, keys = self.__sources.pop(source, (None, ()))
+            for k in keys:
+                entries = [e for e in self.__index.get(k, ()) if e[0] != source]
+                if entries: self.__index[k] = entries
+                else: self.__index.pop(k, None)
+
+            if change is None: continue
+
+            mtime, entries = change
+            for k, (username, entry) in entries:
+                self.__index.setdefault(k, []).append((source, username, entry))
+            self.__sources[source] = (mtime, [k for k, _ in entries])
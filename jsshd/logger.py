@@ -1,12 +1,24 @@
 
 import os
+import copy
+import queue
+import atexit
 import logging
 from logging import FileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
 
 logger = logging.getLogger(__package__)
 
 
+# subsystem loggers, fake connections log to a child of the asyncssh logger
+SUBSYSTEMS = ('jsshd', 'asyncssh', 'asyncssh.fake')
+
+_DEFAULT_LEVELS = {'jsshd': 'INFO', 'asyncssh': 'INFO', 'asyncssh.fake': 'WARNING'}
+
+_DEFAULT_QUEUE_SIZE = 10000
+
+
 _title_str_count = 100
 
 def _title(msg, *args, **kwargs):
@@ -19,26 +31,96 @@ def _title(msg, *args, **kwargs):
 logger.title = _title
 
 
-def initialize(log_file_path):
-    global _logger
 
+class _DroppingQueueHandler(QueueHandler):
+    """Never blocks the caller: records which do not fit in the queue are dropped and counted"""
+
+    def __init__(self, q):
+        super(_DroppingQueueHandler, self).__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # args may change before the listener thread formats the record, everything else is left to it;
+        # the caller's record goes on to its other handlers, so the queued one is a copy
+        if not record.args: return record
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+
+
+_pipeline = None        # (queue handler, listener)
+
+
+def _start(handlers, levels, queue_size):
+    global _pipeline
+
+    levels = dict(_DEFAULT_LEVELS, **(levels or {}))
+    handler = _DroppingQueueHandler(queue.Queue(queue_size))
+    listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+
+    for name in SUBSYSTEMS:
+        l = logging.getLogger(name)
+        l.setLevel(levels[name])
+        # children propagate to their subsystem logger
+        l.handlers = [] if '.' in name else [handler]
+
+    listener.start()
+    _pipeline = (handler, listener)
+
+
+def initialize(log_file_path, levels=None, queue_size=_DEFAULT_QUEUE_SIZE,
+               rotate_bytes=0, rotate_when=None, backup_count=5):
+    """
+    Log the subsystems through a bounded queue, formatting and writing (and rotating the file)
+    happen in a listener thread. levels maps names of SUBSYSTEMS to a level.
+    """
     # base config
     log_fmt = '%(levelname)s %(asctime)s %(filename)s[line:%(lineno)d]: %(message)s'
     date_fmt = '%Y-%m-%d %H:%M:%S'
     formatter = logging.Formatter(log_fmt, date_fmt)
-    logger.setLevel(logging.INFO)
+    handlers = []
 
-    # create file handler
+    # create file handler, rotated by size or by time
     if log_file_path:
         os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
-        fh = FileHandler(log_file_path)
+        if rotate_bytes:
+            fh = RotatingFileHandler(log_file_path, maxBytes=rotate_bytes, backupCount=backup_count)
+        elif rotate_when:
+            fh = TimedRotatingFileHandler(log_file_path, when=rotate_when, backupCount=backup_count)
+        else:
+            fh = FileHandler(log_file_path)
         fh.setFormatter(formatter)
-        logger.addHandler(fh)
+        handlers.append(fh)
 
     # steam handler
     sh = logging.StreamHandler()
     sh.setFormatter(formatter)
-    logger.addHandler(sh)
+    handlers.append(sh)
+
+    _start(handlers, levels, queue_size)
+    atexit.register(shutdown)
+
+
+def redirect(handler, levels=None, queue_size=_DEFAULT_QUEUE_SIZE):
+    """Send the records of a forked worker to handler instead, the parent's listener thread is not forked"""
+    global _pipeline
+    _pipeline = None
+    _start([handler], levels, queue_size)
+
 
+def shutdown():
+    """Stop the listener once the queued records are written"""
+    global _pipeline
+    if _pipeline is None: return
+    _pipeline[1].stop()
+    _pipeline = None
 
 
+def dropped_records(): return 0 if _pipeline is None else _pipeline[0].dropped
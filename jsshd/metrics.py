@@ -0,0 +1,333 @@
+import os
+import stat
+import socket
+import asyncio
+from abc import ABCMeta, abstractmethod
+
+from pyplus.collection import qdict
+
+from jsshd.logger import logger, dropped_records
+from jsshd.fake.protocol import packet_name
+
+
+def _labels(labels):
+    if not labels: return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+
+class Metric(metaclass=ABCMeta):
+    TYPE = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+
+    @abstractmethod
+    def samples(self):
+        """[(name suffix, ((label, value), ...), sample value), ...]"""
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.TYPE)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _labels(labels), value))
+        return '\n'.join(lines)
+
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, help):
+        super(Counter, self).__init__(name, help)
+        self.value = 0
+
+    def inc(self, n=1): self.value += n
+
+    def samples(self): return [('', (), self.value)]
+
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def dec(self, n=1): self.value -= n
+
+    def set(self, v): self.value = v
+
+
+
+class CallbackGauge(Metric):
+    """Gauge read from func() at scrape time"""
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, func):
+        super(CallbackGauge, self).__init__(name, help)
+        self.func = func
+
+    def samples(self): return [('', (), self.func())]
+
+
+
+class CallbackCounter(CallbackGauge):
+    """Counter read from func() at scrape time"""
+    TYPE = 'counter'
+
+
+
+class LabeledCounter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, help, label):
+        super(LabeledCounter, self).__init__(name, help)
+        self.label = label
+        self.values = {}
+
+    def inc(self, value, n=1): self.values[value] = self.values.get(value, 0) + n
+
+    def samples(self): return [('', ((self.label, k),), v) for k, v in sorted(self.values.items())]
+
+
+
+class PacketCounter(Metric):
+    """
+    Packets and bytes per direction and packet type.
+
+    Recording is two list increments, so it can sit on the relay path: callers index
+    packets[pkttype] / bytes[pkttype] of the direction list returned by direction().
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name, help, directions):
+        super(PacketCounter, self).__init__(name, help)
+        self.__directions = {d: ([0] * 256, [0] * 256) for d in directions}
+
+    def direction(self, name): return self.__directions[name]
+
+    def samples(self):
+        result = []
+        for direction, (packets, sizes) in self.__directions.items():
+            for pkttype in range(256):
+                if not packets[pkttype]: continue
+                labels = (('direction', direction), ('type', packet_name(pkttype)))
+                result.append(('_packets_total', labels, packets[pkttype]))
+                result.append(('_bytes_total', labels, sizes[pkttype]))
+        return result
+
+    def render(self):
+        # one metric family per suffix
+        lines = []
+        for suffix, kind in (('_packets_total', 'packets'), ('_bytes_total', 'bytes')):
+            lines.append('# HELP {}{} {} ({})'.format(self.name, suffix, self.help, kind))
+            lines.append('# TYPE {}{} counter'.format(self.name, suffix))
+            lines += ['{}{}{} {}'.format(self.name, s, _labels(l), v) for s, l, v in self.samples() if s == suffix]
+        return '\n'.join(lines)
+
+
+
+class CompressionCounter(Metric):
+    """
+    Compression per leg: uncompressed and compressed bytes and seconds spent in each direction, and
+    how often compression was turned off. leg() returns a qdict of send and recv
+    [raw, compressed, seconds] lists and a disabled count, which callers add to directly.
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name, help, legs):
+        super(CompressionCounter, self).__init__(name, help)
+        self.__legs = {leg: qdict(send=[0, 0, 0.0], recv=[0, 0, 0.0], disabled=0) for leg in legs}
+
+    def leg(self, name): return self.__legs[name]
+
+    def samples(self):
+        result = []
+        for leg, stats in sorted(self.__legs.items()):
+            for direction in ('send', 'recv'):
+                raw, compressed, seconds = stats[direction]
+                if not raw: continue
+                labels = (('leg', leg), ('direction', direction))
+                result.append(('_raw_bytes_total', labels, raw))
+                result.append(('_compressed_bytes_total', labels, compressed))
+                result.append(('_seconds_total', labels, seconds))
+                result.append(('_ratio', labels, compressed / raw))
+            result.append(('_disabled_total', (('leg', leg),), stats.disabled))
+        return result
+
+    def render(self):
+        lines = []
+        for suffix, kind, family in (('_raw_bytes_total', 'uncompressed bytes', 'counter'),
+                                   ('_compressed_bytes_total', 'compressed bytes', 'counter'),
+                                   ('_seconds_total', 'seconds spent', 'counter'),
+                                   ('_ratio', 'compressed / uncompressed bytes', 'gauge'),
+                                   ('_disabled_total', 'turned off for a poor ratio', 'counter')):
+            lines.append('# HELP {}{} {} ({})'.format(self.name, suffix, self.help, kind))
+            lines.append('# TYPE {}{} {}'.format(self.name, suffix, family))
+            lines += ['{}{}{} {}'.format(self.name, s, _labels(l), v) for s, l, v in self.samples() if s == suffix]
+        return '\n'.join(lines)
+
+
+
+class Histogram(Metric):
+    """
+    Histograms of observations per label value with p50/p95/p99 estimated from the buckets.
+    Quantiles are rendered as a separate <name>_quantile gauge family.
+    """
+    TYPE = 'histogram'
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, name, help, label, buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.label = label
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.values = {}        # label value -> [bucket counts, sum]
+
+    def observe(self, value, v):
+        entry = self.values.get(value, None)
+        if entry is None: entry = self.values[value] = [[0] * len(self.buckets), 0.0]
+        for i, bound in enumerate(self.buckets):
+            if v <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += v
+
+    def quantile(self, value, q):
+        entry = self.values.get(value, None)
+        if entry is None: return None
+        counts = entry[0]
+        rank, seen, lower = q * sum(counts), 0, 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and seen + count >= rank:
+                if bound == float('inf'): return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+    def samples(self):
+        result = []
+        for value, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                result.append(('_bucket', ((self.label, value), ('le', le)), cumulative))
+            result.append(('_sum', ((self.label, value),), total))
+            result.append(('_count', ((self.label, value),), cumulative))
+        return result
+
+    def render(self):
+        lines = [super(Histogram, self).render(),
+                 '# HELP {}_quantile {} (estimated quantiles)'.format(self.name, self.help),
+                 '# TYPE {}_quantile gauge'.format(self.name)]
+        for value in sorted(self.values.keys()):
+            for q in self.QUANTILES:
+                labels = ((self.label, value), ('quantile', q))
+                lines.append('{}_quantile{} {}'.format(self.name, _labels(labels), self.quantile(value, q)))
+        return '\n'.join(lines)
+
+
+
+class Registry(object):
+    def __init__(self): self.__metrics = []
+
+    def register(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def render(self): return '\n'.join(m.render() for m in self.__metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+users = REGISTRY.register(Gauge('jsshd_users', 'Active user connections'))
+
+bridges = REGISTRY.register(Gauge('jsshd_bridges', 'Active bridges'))
+
+relayed = REGISTRY.register(PacketCounter('jsshd_relayed', 'Payload relayed by bridges', ('src', 'dst')))
+
+passthroughs = REGISTRY.register(Gauge('jsshd_passthroughs', 'Active passthrough relays'))
+
+passthrough_relayed = REGISTRY.register(LabeledCounter('jsshd_passthrough_relayed_bytes_total',
+                                                       'Bytes relayed by passthroughs', 'direction'))
+
+auth_attempts = REGISTRY.register(LabeledCounter('jsshd_auth_attempts_total', 'Authentication attempts', 'side'))
+
+upstream_connect_failures = REGISTRY.register(Counter('jsshd_upstream_connect_failures_total',
+                                                      'Failed upstream connections'))
+
+admission_rejected = REGISTRY.register(LabeledCounter('jsshd_admission_rejected_total', 'Bridges rejected by limits',
+                                                     'reason'))
+
+acl_denied = REGISTRY.register(Counter('jsshd_acl_denied_total', 'Targets denied by the acl'))
+
+login_phases = REGISTRY.register(Histogram('jsshd_login_phase_seconds', 'Connection setup latency per phase', 'phase'))
+
+recording_backlog = REGISTRY.register(Gauge('jsshd_recording_backlog_bytes', 'Session data waiting to be recorded'))
+
+recording_dropped = REGISTRY.register(Counter('jsshd_recording_dropped_bytes_total',
+                                              'Session data dropped from recordings on a full backlog'))
+
+compression = REGISTRY.register(CompressionCounter('jsshd_compression', 'Compression of bridge legs', ('src', 'dst')))
+
+log_dropped = REGISTRY.register(CallbackCounter('jsshd_log_dropped_records_total', 'Log records dropped on a full queue',
+                                                dropped_records))
+
+
+
+async def _handle_request(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''): pass
+
+        if request.split(b' ')[1:2] == [b'/metrics']:
+            status, body = '200 OK', REGISTRY.render()
+        else:
+            status, body = '404 Not Found', 'not found\n'
+
+        body = body.encode('utf-8')
+        writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n'
+                     .format(status, len(body)).encode('ascii') + body)
+        await writer.drain()
+    except Exception as e:
+        logger.warning('metrics request failed: {}'.format(e))
+    finally:
+        writer.close()
+
+
+def _remove_stale_socket(path):
+    """Unlink a unix socket left by a previous run, one somebody still listens on is kept"""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode): return
+    except FileNotFoundError:
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return
+        except ConnectionRefusedError:
+            pass
+    os.unlink(path)
+    logger.info('removed stale metrics socket {}'.format(path))
+
+
+async def start_server(address, worker=None):
+    """
+    Serve REGISTRY at /metrics in Prometheus text format on 'host:port' or 'unix:/path'.
+    Every worker serves its own registry, on port + worker + 1 or on path.worker.
+    """
+    if address.startswith('unix:'):
+        path = address[5:] if worker is None else '{}.{}'.format(address[5:], worker)
+        _remove_stale_socket(path)
+        server = await asyncio.start_unix_server(_handle_request, path)
+    else:
+        host, port = address.rsplit(':', 1)
+        port = int(port) if worker is None else int(port) + worker + 1
+        server = await asyncio.start_server(_handle_request, host, port)
+        path = '{}:{}'.format(host, port)
+
+    logger.info('metrics served on {}'.format(path))
+    return server
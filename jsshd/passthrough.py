@@ -0,0 +1,150 @@
+import socket
+import asyncio
+
+from asyncssh import ChannelOpenError, OPEN_CONNECT_FAILED
+
+from jsshd import metrics
+from jsshd.logger import logger
+
+
+
+class PassthroughParams(object):
+    """Read-only parameters shared by every passthrough of a service, built once from Config"""
+
+    __slots__ = ('window', 'max_pktsize', 'socket_buffer', 'buffer_limits')
+
+    def __init__(self, window, max_pktsize, socket_buffer=0, buffer_limits=None):
+        # receive window and max packet size of the user's channel
+        self.window = window
+        self.max_pktsize = max_pktsize
+        # SO_SNDBUF and SO_RCVBUF of the destination socket, 0 keeps the system's
+        self.socket_buffer = socket_buffer
+        # (high, low) watermarks of the channel's and the socket's write buffers
+        self.buffer_limits = buffer_limits
+
+
+
+class _Destination(asyncio.Protocol):
+    """TCP connection to the destination, hands everything straight to the channel"""
+
+    def __init__(self, passthrough):
+        self.chan = None
+        self.passthrough = passthrough
+
+    def connection_made(self, transport):
+        # nothing is read before the channel is open, see Passthrough.connection_made
+        transport.pause_reading()
+
+    def data_received(self, data):
+        metrics.passthrough_relayed.inc('dst', len(data))
+        self.chan.write(data)
+
+    def eof_received(self):
+        if self.chan is not None: self.chan.write_eof()
+        return True
+
+    def pause_writing(self):
+        if self.chan is not None: self.chan.pause_reading()
+
+    def resume_writing(self):
+        if self.chan is not None: self.chan.resume_reading()
+
+    def connection_lost(self, exc): self.passthrough.destination_lost(exc)
+
+
+
+class Passthrough(object):
+    """
+    Relay of a direct-tcpip channel to a TCP connection to its destination, like the user's
+    ssh -J would do. The user's SSH session runs end to end through it, so nothing is decrypted,
+    recorded or traced, and every byte is encrypted once instead of twice.
+
+    It is the SSH session of the channel, data is written to the other side directly and
+    pause_writing of either side pauses reading on the other.
+    """
+
+    def __init__(self, dest_host, dest_port, params, on_close=None):
+        self.__dest_host = dest_host
+        self.__dest_port = dest_port
+        self.__params = params
+        self.__on_close = on_close
+        self.__transport = None
+        self.__protocol = None
+        self.__chan = None
+        self.__closed = False
+        metrics.passthroughs.inc()
+
+
+    @property
+    def channel(self): return self.__chan
+
+    @property
+    def transport(self): return self.__transport
+
+
+    async def initialize(self):
+        """Connect to the destination and return the session, connection_requested returns it with the channel"""
+        params = self.__params
+        loop = asyncio.get_event_loop()
+        try:
+            self.__transport, self.__protocol = await loop.create_connection(
+                lambda: _Destination(self), self.__dest_host or None, self.__dest_port)
+        except OSError as exc:
+            self.__close()
+            raise ChannelOpenError(OPEN_CONNECT_FAILED, str(exc)) from None
+
+        sock = self.__transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if params.socket_buffer:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, params.socket_buffer)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, params.socket_buffer)
+        if params.buffer_limits is not None: self.__transport.set_write_buffer_limits(*params.buffer_limits)
+        return self
+
+
+    def __close(self):
+        if self.__closed: return
+        self.__closed = True
+        metrics.passthroughs.dec()
+        if self.__on_close is not None: self.__on_close()
+
+
+    def destination_lost(self, exc):
+        logger.debug('passthrough {}:{} destination lost: {}'.format(self.__dest_host, self.__dest_port, exc))
+        self.__transport = None
+        if self.__chan is not None: self.__chan.close()
+        else: self.__close()
+
+
+# ================================ SSH SESSION ================================ #
+
+    def connection_made(self, chan):
+        self.__chan = chan
+        if self.__params.buffer_limits is not None: chan.set_write_buffer_limits(*self.__params.buffer_limits)
+        if self.__transport is None:
+            chan.close()
+            return
+
+        self.__protocol.chan = chan
+        self.__transport.resume_reading()
+
+    def session_started(self): pass
+
+    def data_received(self, data, datatype):
+        metrics.passthrough_relayed.inc('src', len(data))
+        if self.__transport is not None: self.__transport.write(data)
+
+    def eof_received(self):
+        if self.__transport is not None and self.__transport.can_write_eof(): self.__transport.write_eof()
+        return True
+
+    def pause_writing(self):
+        if self.__transport is not None: self.__transport.pause_reading()
+
+    def resume_writing(self):
+        if self.__transport is not None: self.__transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.__transport is not None: self.__transport.close()
+        self.__close()
@@ -0,0 +1,99 @@
+import asyncio
+from collections import OrderedDict
+
+
+class UpstreamPool(object):
+    """
+    Idle, authenticated upstream connections keyed by (host, port, username).
+
+    A connection is checked out by exactly one bridge at a time. Idle connections are closed
+    after idle_timeout, at most max_per_host are kept for a (host, port) and the least recently
+    released one is evicted once max_size is reached.
+    """
+
+    def __init__(self, max_size, max_per_host, idle_timeout, loop=None, timers=None):
+        self.__max_size = max_size
+        self.__max_per_host = max_per_host
+        self.__idle_timeout = idle_timeout
+        self.__loop = loop or asyncio.get_event_loop()
+        # anything with the loop's call_later, e.g. a jsshd.timer.TimerWheel
+        self.__timers = timers or self.__loop
+
+        self.__idle = OrderedDict()         # conn -> (key, timer), oldest first
+        self.__keys = {}                    # key -> [conn, ...], newest last
+        self.__hosts = {}                   # (host, port) -> idle count
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __len__(self): return len(self.__idle)
+
+
+    def acquire(self, host, port, username):
+        conns = self.__keys.get((host, port, username), None)
+        if not conns:
+            self.misses += 1
+            return None
+
+        conn = conns[-1]
+        self.__remove(conn)
+        self.hits += 1
+        return conn
+
+
+    def release(self, host, port, username, conn):
+        """Return conn to the pool, or return False if the caller has to close it"""
+        if self.__max_size <= 0 or conn in self.__idle: return False
+        if self.__hosts.get((host, port), 0) >= self.__max_per_host: return False
+
+        while len(self.__idle) >= self.__max_size:
+            self.__evict(next(iter(self.__idle)))
+
+        key = (host, port, username)
+        timer = self.__timers.call_later(self.__idle_timeout, self.__evict, conn)
+        self.__idle[conn] = (key, timer)
+        self.__keys.setdefault(key, []).append(conn)
+        self.__hosts[(host, port)] = self.__hosts.get((host, port), 0) + 1
+
+        conn.process_packet_callback = None
+        conn.set_redirect(None)
+        conn.listener_relay.target = self
+        return True
+
+
+    def close(self):
+        # connections released later are closed by their bridge
+        self.__max_size = 0
+        for conn in list(self.__idle.keys()): self.__evict(conn)
+
+
+    # listener callbacks of idle connections, see bridge._ListenerRelay
+
+    def connection_lost(self, exc, messager):
+        if messager in self.__idle: self.__remove(messager)
+
+    def pause_writing(self, messager): pass
+
+    def resume_writing(self, messager): pass
+
+
+    def __remove(self, conn):
+        key, timer = self.__idle.pop(conn)
+        timer.cancel()
+
+        conns = self.__keys[key]
+        conns.remove(conn)
+        if not conns: del self.__keys[key]
+
+        host = key[:2]
+        self.__hosts[host] -= 1
+        if self.__hosts[host] == 0: del self.__hosts[host]
+
+
+    def __evict(self, conn):
+        if conn not in self.__idle: return
+        self.__remove(conn)
+        self.evictions += 1
+        conn.close()
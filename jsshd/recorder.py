@@ -0,0 +1,168 @@
+import os
+import gzip
+import json
+import time
+import codecs
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from asyncssh.constants import MSG_CHANNEL_DATA, MSG_CHANNEL_EXTENDED_DATA
+
+from jsshd import metrics
+from jsshd.logger import logger
+
+
+_DEFAULT_MAX_BACKLOG = 8 * 1024 * 1024
+
+_DEFAULT_FLUSH_INTERVAL = 1.0
+
+# offset of the data string's content in a channel data payload
+_DATA_OFFSETS = {MSG_CHANNEL_DATA: 9, MSG_CHANNEL_EXTENDED_DATA: 13}
+
+
+
+class Recording(object):
+    """
+    One session in asciicast v2 format, 'i' events are sent by the user and 'o' events by the upstream.
+    record() only queues, the file is written by the recorder's writer thread.
+    """
+
+    def __init__(self, recorder, path, header, compress):
+        self.__recorder = recorder
+        self.__path = path
+        self.__header = header
+        self.__compress = compress
+        self.__started = time.monotonic()
+        self.__file = None
+        self.__failed = False
+        self.__decoders = {k: codecs.getincrementaldecoder('utf-8')('replace') for k in 'io'}
+        self.pending = []
+        self.closed = False
+
+    @property
+    def path(self): return self.__path
+
+    def record(self, kind, pkttype, payload):
+        if self.closed: return
+        data = payload[_DATA_OFFSETS[pkttype]:]
+        self.__recorder.enqueue(self, (time.monotonic() - self.__started, kind, data))
+
+    def close(self): self.closed = True
+
+    # writer thread
+
+    def write(self, events, close=False):
+        if self.__failed: return
+        try:
+            if self.__file is None:
+                self.__file = gzip.open(self.__path, 'wt', encoding='utf-8') if self.__compress else \
+                              open(self.__path, 'w', encoding='utf-8')
+                self.__file.write(json.dumps(self.__header) + '\n')
+
+            self.__file.writelines(json.dumps([round(t, 6), k, self.__decoders[k].decode(d)]) + '\n'
+                                   for t, k, d in events)
+            if close: self.__close_file()
+            elif not self.__compress: self.__file.flush()
+        except Exception as e:
+            logger.warning('recording {} failed, closing it: {}'.format(self.__path, e))
+            self.__failed = self.closed = True
+            self.__close_file()
+
+    def __close_file(self):
+        f, self.__file = self.__file, None
+        if f is None: return
+        try:
+            f.close()
+        except Exception as e:
+            logger.warning('closing recording {} failed: {}'.format(self.__path, e))
+
+
+
+class SessionRecorder(object):
+    """
+    Tee of bridged channel data into per-session recordings under directory.
+
+    Events wait in memory until the background task hands them to a single writer thread which
+    encodes, compresses and writes them, so the relay path never touches the disk. Events beyond
+    max_backlog bytes are dropped, the backlog and the drops are exported as metrics.
+    """
+
+    def __init__(self, directory, compress=False, max_backlog=_DEFAULT_MAX_BACKLOG,
+                 flush_interval=_DEFAULT_FLUSH_INTERVAL, loop=None):
+        self.__directory = directory
+        self.__compress = compress
+        self.__max_backlog = max_backlog
+        self.__flush_interval = flush_interval
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(directory, exist_ok=True)
+        self.__recordings = set()
+        self.__backlog = 0
+        self.__task = None
+
+
+    @property
+    def backlog(self): return self.__backlog
+
+
+    def open(self, recording_id, **header):
+        """
+        Start a recording named from the time, the worker's pid and recording_id, which must be an
+        int. Anything client-chosen such as user names or hosts belongs in header.
+        """
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        name = '{}-{}-{:d}.cast{}'.format(stamp, os.getpid(), recording_id, '.gz' if self.__compress else '')
+        directory = os.path.realpath(self.__directory)
+        path = os.path.join(directory, name)
+        if os.path.dirname(os.path.realpath(path)) != directory:
+            raise ValueError('Recording path {} outside of {}'.format(path, directory))
+        header = dict(version=2, width=80, height=24, timestamp=int(time.time()), **header)
+        recording = Recording(self, path, header, self.__compress)
+        self.__recordings.add(recording)
+        return recording
+
+
+    def enqueue(self, recording, event):
+        size = len(event[2])
+        if self.__backlog + size > self.__max_backlog:
+            metrics.recording_dropped.inc(size)
+            return
+        recording.pending.append(event)
+        self.__backlog += size
+        metrics.recording_backlog.set(self.__backlog)
+
+
+    def start(self):
+        if self.__task is None: self.__task = self.__loop.create_task(self.__run())
+
+
+    async def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        for recording in self.__recordings: recording.closed = True
+        await self.flush()
+        self.__executor.shutdown(wait=False)
+
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.__flush_interval)
+            await self.flush()
+
+
+    async def flush(self):
+        for recording in list(self.__recordings):
+            events, recording.pending, close = recording.pending, [], recording.closed
+            if close: self.__recordings.discard(recording)
+            if not events and not close: continue
+
+            try:
+                await self.__loop.run_in_executor(self.__executor, recording.write, events, close)
+            except Exception as e:
+                logger.warning('recording {} failed: {}'.format(recording.path, e))
+                recording.closed = True
+                self.__recordings.discard(recording)
+            finally:
+                self.__backlog -= sum(len(e[2]) for e in events)
+                metrics.recording_backlog.set(self.__backlog)
@@ -1,37 +1,97 @@
 
 import signal
-import sys
+import socket
 import asyncio
 import asyncssh
-import logging
 
+from jsshd import eventloop, metrics
+from jsshd.trace import TRACER
+from jsshd.logger import logger
 from jsshd.user import UserEntity
+from jsshd.pool import UpstreamPool
+from jsshd.bridge import BridgeParams
+from jsshd.passthrough import PassthroughParams
+from jsshd.recorder import SessionRecorder
+from jsshd.keystore import KeyStore
+from jsshd.acl import AclPolicy, ModePolicy
+from jsshd.admission import AdmissionControl
+from jsshd.timer import TimerWheel, Keepalive
+from jsshd.fake import server, client
+
+
+# listen with SO_REUSEPORT so that a reloaded listener can bind before the old one is closed
+_REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')
+
+
+def _server_algs(config):
+    # algorithms of the user side, the user connection and the bridges' fake servers
+    return dict(kex_algs=config.server_kex_algs, encryption_algs=config.server_encryption_algs,
+                mac_algs=config.server_mac_algs)
+
+
+def _upstream_algs(config):
+    return dict(kex_algs=config.upstream_kex_algs, encryption_algs=config.upstream_encryption_algs,
+                mac_algs=config.upstream_mac_algs, compression_algs=config.upstream_compression_algs)
+
+
+def _bridge_server_algs(config):
+    # compression only applies to the fake servers, the user connection carries their encrypted packets
+    return dict(_server_algs(config), compression_algs=config.server_compression_algs)
+
+
+def _load_keystore(config):
+    if not (config.authorized_keys_dir or config.authorized_keys_db): return None
+    keystore = KeyStore(config.authorized_keys_dir, config.authorized_keys_db).load()
+    logger.info('{} authorized keys loaded'.format(len(keystore)))
+    return keystore
+
+
+def _load_policies(config):
+    """
+    Build the key store, the acl and the profiles of the bridges' fake connections, which may take
+    a while with many keys and rules. Runs in the executor on reload.
+    """
+    # parse host keys and upstream credentials once for every bridge
+    profiles = server.build_profile(config.server_host_keys, **_bridge_server_algs(config)), \
+               client.build_profile(config.client_keys, **_upstream_algs(config))
+    return _load_keystore(config), AclPolicy(config.acl_file) if config.acl_file else None, profiles
 
 
 class Service(object):
-    def __init__(self, config):
+    def __init__(self, config, worker=None):
         self.__config = config
+        self.__worker = worker
         self.__server = None
+        self.__metrics_server = None
+        self.__pool = None
+        self.__bridge_params = None
+        self.__passthrough_params = None
+        self.__modes = None
+        self.__recorder = None
+        self.__recording_settings = None
+        self.__keystore = None
+        self.__acl = None
+        self.__admission = AdmissionControl()
+        self.__timers = None
+        self.__users = set()
+        self.__reloading = False
+        self.__stopped = None
+        self.__drained = None
 
     def __call__(self, *args, **kwargs):
-        # set asyncssh log
-        asyncssh.set_log_level(logging.DEBUG)
-        sh = logging.StreamHandler()
-        asyncssh.logger.logger.addHandler(sh)
-
+        eventloop.install(self.__config.event_loop)
+        loop = asyncio.get_event_loop()
+        logger.info('event loop: {}'.format(eventloop.describe(loop)))
 
-        # catch exit signal
-        def sigint_handler(signum, frame):
-            print('catched interrupt signal and ready to exit')
-            asyncio.get_event_loop().stop()
-            sys.exit(0)
+        # reload on SIGHUP, drain and exit on SIGINT and SIGTERM
+        loop.add_signal_handler(signal.SIGHUP, self.reload)
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
 
-        signal.signal(signal.SIGINT, sigint_handler)
-        signal.signal(signal.SIGHUP, sigint_handler)
-        signal.signal(signal.SIGTERM, sigint_handler)
+        # dump the sampled packet trace
+        loop.add_signal_handler(signal.SIGUSR1, TRACER.dump)
 
         # run loop
-        loop = asyncio.get_event_loop()
         loop.run_until_complete(self.__async_loop())
         loop.close()
 
@@ -39,20 +99,215 @@ class Service(object):
     @property
     def config(self): return self.__config
 
+    @property
+    def pool(self): return self.__pool
+
+    @property
+    def bridge_params(self): return self.__bridge_params
+
+    @property
+    def passthrough_params(self): return self.__passthrough_params
+
+    @property
+    def modes(self): return self.__modes
+
+    @property
+    def keystore(self): return self.__keystore
+
+    @property
+    def acl(self): return self.__acl
+
+    @property
+    def admission(self): return self.__admission
+
+
+    def keepalive(self, conn):
+        """Start the keepalive of a user connection, None if disabled"""
+        if not self.__config.keepalive_interval: return None
+        return Keepalive(self.__timers, conn, self.__config.keepalive_interval, self.__config.keepalive_count_max)
+
+
+    def reload(self):
+        """Load config and keys again and replace the listener, connections of the old one keep running"""
+        if self.__reloading or self.__stopped.is_set(): return
+        self.__reloading = True
+        asyncio.get_event_loop().create_task(self.__reload())
+
+
+    def stop(self):
+        """Stop listening and wait up to DRAIN_TIMEOUT for the connections to close, a second call skips the wait"""
+        if self.__stopped.is_set():
+            self.__drained.set()
+        else:
+            logger.info('catched stop signal and ready to drain')
+            self.__stopped.set()
+
 
     async def __async_loop(self):
-        # create server
-        self.__server = await asyncssh.create_server(
+        self.__stopped = asyncio.Event()
+        self.__drained = asyncio.Event()
+
+        # every keepalive, idle timeout and pool expiry runs on one timer wheel
+        self.__timers = TimerWheel()
+        self.__register_pool_metrics()
+
+        self.__setup(self.__config, *_load_policies(self.__config))
+        self.__server = await self.__listen(self.__config)
+
+        # metrics endpoint
+        self.__metrics_server = await self.__start_metrics(self.__config.metrics_address)
+
+        await self.__stopped.wait()
+        await self.__drain()
+
+
+    async def __start_metrics(self, address):
+        # the endpoint is optional, failing to serve it must not stop the service
+        if not address: return None
+        try:
+            return await metrics.start_server(address, self.__worker)
+        except Exception as e:
+            logger.error('metrics server on {} failed: {}'.format(address, e))
+            return None
+
+
+    def __setup(self, config, keystore, acl, profiles):
+        self.__keystore = keystore
+        self.__acl = acl
+
+        server_profile, client_profile = profiles
+        server.install_profiles(server_profile)
+        client.install_profiles(client_profile)
+
+        TRACER.configure(config.packet_trace_size, config.packet_trace_rate)
+
+        self.__admission.configure(config.max_bridges, config.max_bridges_per_user,
+                                   config.user_connect_rate, config.user_connect_burst,
+                                   config.address_connect_rate, config.address_connect_burst)
+
+        # reuse authenticated upstream connections. A reload starts a new pool, the old one closes its
+        # idle connections, which may use replaced credentials, and those of running bridges on release
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool = None
+        if config.upstream_pool_size > 0:
+            self.__pool = UpstreamPool(config.upstream_pool_size,
+                                       config.upstream_pool_max_per_host,
+                                       config.upstream_pool_idle_timeout,
+                                       timers=self.__timers)
+
+        # record bridged sessions, running recordings keep the recorder until a restart
+        recording = (config.recording_dir, config.recording_compress, config.recording_max_backlog)
+        if self.__recorder is None and config.recording_dir:
+            self.__recorder = SessionRecorder(*recording)
+            self.__recorder.start()
+            self.__recording_settings = recording
+        elif self.__recorder is not None and recording != self.__recording_settings:
+            logger.warning('RECORDING_* changes take effect after a restart')
+
+        # parameters shared by every new bridge, running bridges keep theirs
+        self.__bridge_params = BridgeParams(
+            dict({
+                'server_host_keys': config.server_host_keys
+            }, **_bridge_server_algs(config)),
+            dict({
+                'client_keys': config.client_keys,
+                'known_hosts': None
+            }, **_upstream_algs(config)),
+            pool=self.__pool,
+            buffer_limits=(config.bridge_write_high_watermark,
+                           config.bridge_write_low_watermark,
+                           config.bridge_max_buffer_size),
+            slow_login_threshold=config.slow_login_threshold,
+            speculative_connect=config.upstream_speculative_connect,
+            recorder=self.__recorder,
+            timers=self.__timers,
+            idle_timeout=config.bridge_idle_timeout,
+            upstream_keepalive=(config.upstream_keepalive_interval, config.keepalive_count_max)
+                               if config.upstream_keepalive_interval else None,
+            windows=(config.bridge_min_window, config.bridge_max_window) if config.bridge_adaptive_window else None,
+            compression=(config.compression_disable_ratio, config.compression_retry_interval))
+
+        # bridge or pass through each destination
+        self.__modes = ModePolicy(config.bridge_mode, config.bridge_targets, config.passthrough_targets)
+        self.__passthrough_params = PassthroughParams(
+            config.passthrough_window, config.passthrough_max_pktsize, config.passthrough_socket_buffer,
+            buffer_limits=(config.bridge_write_high_watermark, config.bridge_write_low_watermark))
+
+
+    async def __listen(self, config):
+        return await asyncssh.create_server(
             lambda : UserEntity(self),
             '',
-            self.__config.port,
-            server_host_keys=self.__config.server_host_keys,
+            config.port,
+            server_host_keys=config.server_host_keys,
             allow_scp=True,
+            reuse_port=_REUSE_PORT,
+            **_server_algs(config)
         )
 
 
-        await asyncio.sleep(3600.0)
+    async def __reload(self):
+        try:
+            config = self.__config.reload()
+            policies = await asyncio.get_event_loop().run_in_executor(None, _load_policies, config)
+            self.__setup(config, *policies)
+
+            # without SO_REUSEPORT the port is released before it is bound again
+            if _REUSE_PORT or config.port != self.__config.port:
+                listener = await self.__listen(config)
+                self.__server.close()
+            else:
+                self.__server.close()
+                listener = await self.__listen(config)
+            self.__server = listener
+
+            if config.metrics_address != self.__config.metrics_address:
+                if self.__metrics_server is not None: self.__metrics_server.close()
+                self.__metrics_server = None
+                self.__metrics_server = await self.__start_metrics(config.metrics_address)
+
+            self.__config = config
+            logger.info('reloaded, {} connections of the old listener are kept'.format(len(self.__users)))
+        except Exception as e:
+            logger.error('reload failed: {}'.format(e))
+        finally:
+            self.__reloading = False
+
+
+    async def __drain(self):
+        self.__server.close()
+        if not self.__users: self.__drained.set()
 
+        logger.info('draining {} connections for at most {}s'.format(len(self.__users), self.__config.drain_timeout))
+        try:
+            await asyncio.wait_for(self.__drained.wait(), self.__config.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning('closing {} connections after the drain timeout'.format(len(self.__users)))
+
+        for user in list(self.__users): user.connection.close()
+        await asyncio.sleep(0)
+
+        if self.__pool is not None: self.__pool.close()
+        if self.__recorder is not None: await self.__recorder.close()
+        if self.__metrics_server is not None: self.__metrics_server.close()
+        self.__timers.close()
+        logger.info('stopped')
+
+
+    def __register_pool_metrics(self):
+        # read from the current pool, a reload starts them from 0 again
+        def stat(func): return lambda: func(self.__pool) if self.__pool is not None else 0
+        for name, help, func in (('idle', 'Idle pooled upstream connections', len),
+                                 ('hits', 'Upstream pool hits', lambda pool: pool.hits),
+                                 ('misses', 'Upstream pool misses', lambda pool: pool.misses),
+                                 ('evictions', 'Upstream pool evictions', lambda pool: pool.evictions)):
+            metrics.REGISTRY.register(metrics.CallbackGauge('jsshd_upstream_pool_' + name, help, stat(func)))
+
+
+
+    def on_user_connection_made(self, server):
+        self.__users.add(server)
 
 
     def on_user_auth_completed(self, server):
@@ -60,7 +315,8 @@ class Service(object):
 
 
     def on_user_connection_lost(self, server):
-        pass
+        self.__users.discard(server)
+        if not self.__users and self.__stopped.is_set(): self.__drained.set()
 
 
 
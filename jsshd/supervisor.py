@@ -0,0 +1,133 @@
+import os
+import time
+import signal
+import socket
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+from logging.handlers import QueueHandler, QueueListener
+
+from jsshd import logger as logging_pipeline
+from jsshd.sshd import Service
+from jsshd.logger import logger
+
+
+# a worker slot is not restarted more often than this
+_RESTART_DELAY = 1.0
+
+# seconds workers get to exit after SIGTERM and their drain before they are killed
+_STOP_TIMEOUT = 10.0
+
+class _WorkerLogHandler(QueueHandler):
+    def prepare(self, record):
+        record = super(_WorkerLogHandler, self).prepare(record)
+        record.msg = '[worker {}] {}'.format(os.getpid(), record.msg)
+        return record
+
+
+class _LogDispatcher(logging.Handler):
+    # hand records of workers to the supervisor's logger of the same name
+    def emit(self, record): logging.getLogger(record.name).handle(record)
+
+
+
+def _run_worker(config, log_queue, slot):
+    for sig in (signal.SIGINT, signal.SIGHUP, signal.SIGTERM, signal.SIGUSR1): signal.signal(sig, signal.SIG_DFL)
+
+    # pickling for the supervisor's queue happens in the worker's own listener thread
+    logging_pipeline.redirect(_WorkerLogHandler(log_queue), config.log_levels, config.log_queue_size)
+
+    try:
+        Service(config, worker=slot)()
+    finally:
+        logging_pipeline.shutdown()
+
+
+
+class Supervisor(object):
+    """Fork workers which all listen on the config port with SO_REUSEPORT and restart the ones that die"""
+
+    def __init__(self, config, workers):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise Exception('Worker mode needs SO_REUSEPORT which is not available on this platform')
+
+        self.__config = config
+        self.__workers = workers
+        self.__context = multiprocessing.get_context('fork')
+        self.__log_queue = None
+        self.__processes = {}
+        self.__started = {}
+        self.__stopping = False
+        self.__reload = False
+
+
+    def __call__(self, *args, **kwargs):
+        self.__log_queue = self.__context.Queue(-1)
+        listener = QueueListener(self.__log_queue, _LogDispatcher())
+        listener.start()
+
+        def stop_handler(signum, frame):
+            logger.info('catched signal {} and ready to stop workers'.format(signum))
+            self.__stopping = True
+
+        def forward_handler(signum, frame):
+            # restarted workers get the reloaded config too
+            if signum == signal.SIGHUP: self.__reload = True
+            for p in self.__processes.values():
+                if p.is_alive(): os.kill(p.pid, signum)
+
+        signal.signal(signal.SIGINT, stop_handler)
+        signal.signal(signal.SIGTERM, stop_handler)
+        signal.signal(signal.SIGHUP, forward_handler)
+        signal.signal(signal.SIGUSR1, forward_handler)
+
+        try:
+            for slot in range(self.__workers): self.__start(slot)
+            self.__watch()
+        finally:
+            self.__stop()
+            listener.stop()
+
+
+    def __start(self, slot):
+        p = self.__context.Process(target=_run_worker, args=(self.__config, self.__log_queue, slot),
+                                   name='jsshd-worker-{}'.format(slot), daemon=True)
+        p.start()
+        self.__processes[slot] = p
+        self.__started[slot] = time.monotonic()
+        logger.info('worker {} started with pid {}'.format(slot, p.pid))
+
+
+    def __watch(self):
+        pending = set()
+        while not self.__stopping:
+            alive = [p.sentinel for slot, p in self.__processes.items() if slot not in pending]
+            wait(alive, timeout=_RESTART_DELAY)
+
+            if self.__reload:
+                self.__reload = False
+                try:
+                    self.__config = self.__config.reload()
+                except Exception as e:
+                    logger.error('reload failed: {}'.format(e))
+
+            for slot, p in self.__processes.items():
+                if slot in pending or p.is_alive(): continue
+                logger.error('worker {} (pid {}) exited with code {}'.format(slot, p.pid, p.exitcode))
+                pending.add(slot)
+
+            for slot in list(pending):
+                if self.__stopping: break
+                if time.monotonic() - self.__started[slot] < _RESTART_DELAY: continue
+                pending.discard(slot)
+                self.__start(slot)
+
+
+    def __stop(self):
+        for p in self.__processes.values():
+            if p.is_alive(): p.terminate()
+
+        deadline = time.monotonic() + self.__config.drain_timeout + _STOP_TIMEOUT
+        for p in self.__processes.values():
+            p.join(max(0.0, deadline - time.monotonic()))
+            if p.is_alive(): p.kill()
@@ -0,0 +1,146 @@
+import asyncio
+
+from asyncssh.misc import DisconnectError
+from asyncssh.constants import DISC_CONNECTION_LOST
+
+from jsshd.logger import logger
+
+
+_DEFAULT_TICK = 1.0
+
+_DEFAULT_SLOTS = 512
+
+
+
+class _Timer(object):
+    __slots__ = ('callback', 'args', 'rounds', 'cancelled')
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self): self.cancelled = True
+
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel with a resolution of tick seconds.
+
+    Scheduling and cancelling are O(1) and only one loop timer runs, every tick while there are
+    timers, so tens of thousands of connection timers cost almost nothing. call_later() has the
+    signature of the loop's and returns a handle with cancel(), it can stand in for the loop.
+    """
+
+    def __init__(self, tick=_DEFAULT_TICK, slots=_DEFAULT_SLOTS, loop=None):
+        self.__tick = tick
+        self.__slots = [[] for _ in range(slots)]
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__current = 0
+        self.__count = 0
+        self.__handle = None
+        self.__next = None
+
+
+    def __len__(self): return self.__count
+
+
+    def call_later(self, delay, callback, *args):
+        ticks = max(1, int(delay / self.__tick + 0.999999))
+        timer = _Timer(callback, args, (ticks - 1) // len(self.__slots))
+        self.__slots[(self.__current + ticks) % len(self.__slots)].append(timer)
+        self.__count += 1
+
+        if self.__handle is None:
+            self.__next = self.__loop.time() + self.__tick
+            self.__handle = self.__loop.call_at(self.__next, self.__advance)
+        return timer
+
+
+    def close(self):
+        if self.__handle is not None: self.__handle.cancel()
+        self.__handle = None
+        for slot in self.__slots: slot.clear()
+        self.__count = 0
+
+
+    def __advance(self):
+        self.__current = (self.__current + 1) % len(self.__slots)
+        slot, due = self.__slots[self.__current], []
+
+        kept = []
+        for timer in slot:
+            if timer.cancelled: continue
+            if timer.rounds:
+                timer.rounds -= 1
+                kept.append(timer)
+            else:
+                due.append(timer)
+        self.__count -= len(slot) - len(kept)
+        self.__slots[self.__current] = kept
+
+        # the next tick is scheduled first, callbacks may add timers
+        if self.__count or due:
+            self.__next += self.__tick
+            self.__handle = self.__loop.call_at(self.__next, self.__advance)
+        else:
+            self.__handle = None
+
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logger.warning('timer callback {} failed: {}'.format(timer.callback, e))
+
+
+
+class Keepalive(object):
+    """
+    SSH level keepalive of conn: every interval without a received packet a keepalive@openssh.com
+    request is sent, the connection is aborted after count_max of them went unanswered.
+    Received packets are noticed by comparing conn's receive sequence number at each check.
+    """
+
+    def __init__(self, timers, conn, interval, count_max):
+        self.__timers = timers
+        self.__conn = conn
+        self.__interval = interval
+        self.__count_max = count_max
+        self.__seq = conn._recv_seq
+        self.__missed = 0
+        self.__timer = timers.call_later(interval, self.__check)
+        self.replies = 0
+
+
+    def cancel(self):
+        if self.__timer is not None: self.__timer.cancel()
+        self.__timer = None
+
+
+    def __check(self):
+        conn = self.__conn
+        if conn._transport is None:
+            self.__timer = None
+            return
+
+        # replies wait unread while the bridge pauses reading conn, they do not tell about the peer
+        if conn._recv_seq != self.__seq or getattr(conn, 'read_paused', False):
+            self.__missed = 0
+        elif self.__missed >= self.__count_max:
+            logger.info('keepalive of {}:{} timed out'.format(conn._peer_addr, conn._peer_port))
+            self.__timer = None
+            conn._force_close(DisconnectError(DISC_CONNECTION_LOST, 'Keepalive timeout'))
+            return
+        else:
+            self.__missed += 1
+            conn.create_task(self.__probe())
+
+        self.__seq = conn._recv_seq
+        self.__timer = self.__timers.call_later(self.__interval, self.__check)
+
+
+    async def __probe(self):
+        await self.__conn._make_global_request(b'keepalive@openssh.com')
+        self.replies += 1
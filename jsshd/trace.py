@@ -0,0 +1,46 @@
+import time
+from collections import deque
+
+from jsshd.logger import logger
+from jsshd.fake.protocol import packet_name
+
+
+_DEFAULT_SIZE = 4096
+
+
+
+class PacketTracer(object):
+    """
+    Ring buffer of (time, trace id, direction, packet type, size) of 1 in rate packets.
+    A rate of 0 disables tracing, fake connections then skip it with a single None check.
+    """
+
+    def __init__(self, size=_DEFAULT_SIZE, rate=0):
+        self.configure(size, rate)
+
+    @property
+    def enabled(self): return self.__rate > 0
+
+    def configure(self, size=_DEFAULT_SIZE, rate=0):
+        self.__ring = deque(maxlen=size)
+        self.__rate = rate
+        self.__countdown = rate
+
+    def record(self, trace_id, direction, pkttype, size):
+        self.__countdown -= 1
+        if self.__countdown > 0: return
+        self.__countdown = self.__rate
+        self.__ring.append((time.time(), trace_id, direction, pkttype, size))
+
+    def entries(self, trace_id=None):
+        return [e for e in self.__ring if trace_id is None or e[1] == trace_id]
+
+    def dump(self, trace_id=None, reason='requested'):
+        entries = self.entries(trace_id)
+        lines = ['{:.6f} {} {} {} {}'.format(t, i, d, packet_name(p), s) for t, i, d, p, s in entries]
+        logger.warning('packet trace ({}, {} packets, 1 in {}):\n{}'.format(reason, len(entries), self.__rate,
+                                                                           '\n'.join(lines)))
+
+
+
+TRACER = PacketTracer()
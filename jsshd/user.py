@@ -2,9 +2,12 @@ import os
 from functools import partial
 
 import asyncssh
+from asyncssh import ChannelOpenError, OPEN_RESOURCE_SHORTAGE
 
+from jsshd import metrics
 from jsshd.session import SSHServerSession
 from jsshd.bridge import Bridge
+from jsshd.passthrough import Passthrough
 
 
 
@@ -13,6 +16,9 @@ class UserEntity(asyncssh.SSHServer):
         self.__service = service
         self.__bridge = None
         self.__session = None
+        self.__permitted = None
+        self.__username = None
+        self.__keepalive = None
 
 
     @property
@@ -27,8 +33,14 @@ class UserEntity(asyncssh.SSHServer):
 
     def connection_made(self, conn):
         self.__conn = conn
+        self.__times = {'accepted': conn._loop.time()}
+        metrics.users.inc()
+        self.__keepalive = self.__service.keepalive(conn)
+        self.__service.on_user_connection_made(self)
 
     def connection_lost(self, exc):
+        if self.__keepalive is not None: self.__keepalive.cancel()
+        metrics.users.dec()
         self.__service.on_user_connection_lost(self)
 
 
@@ -37,31 +49,60 @@ class UserEntity(asyncssh.SSHServer):
     def public_key_auth_supported(self): return True
 
     def validate_public_key(self, username, key):
-        # check target ip
+        metrics.auth_attempts.inc('user')
 
-        # check public key
+        # every key is accepted without a key store
+        keystore = self.__service.keystore
+        if keystore is None: return True
 
+        options = keystore.validate(username, key, self.__conn.get_extra_info('peername')[0])
+        if options is None: return False
+
+        # (host, port) targets of permitopen options, port None matches any
+        self.__permitted = options.get('permitopen', None)
+        return True
+
+
+    def begin_auth(self, username):
+        self.__username = username
+        self.__times['auth_started'] = self.__conn._loop.time()
+        metrics.login_phases.observe('client_kex', self.__times['auth_started'] - self.__times['accepted'])
         return True
 
 
     def auth_completed(self):
+        now = self.__conn._loop.time()
+        metrics.login_phases.observe('client_auth', now - self.__times.get('auth_started', now))
         self.__service.on_user_auth_completed(self)
 
 
     def connection_requested(self, dest_host, dest_port, orig_host, orig_port):
         assert self.__bridge is None
 
-        config = self.__service.config
-        self.__bridge = Bridge(orig_host, orig_port,
-                               {
-                                   'server_host_keys': config.server_host_keys
-                               },
-                               {
-                                   'host': dest_host,
-                                   'port': dest_port,
-                                   'client_keys' : config.client_keys,
-                                   'known_hosts': None
-                               })
+        if self.__permitted is not None and \
+                not any(host in ('*', dest_host) and port in (None, dest_port) for host, port in self.__permitted):
+            return False
+
+        acl = self.__service.acl
+        if acl is not None and not acl.check(self.__username, dest_host, dest_port):
+            metrics.acl_denied.inc()
+            return False
+
+        admission = self.__service.admission
+        reason = admission.admit(self.__username, self.__conn.get_extra_info('peername')[0])
+        if reason is not None: raise ChannelOpenError(OPEN_RESOURCE_SHORTAGE, 'Bridge limit reached: ' + reason)
+
+        on_close = partial(admission.release, self.__username)
+        if self.__service.modes.passthrough(dest_host, dest_port):
+            params = self.__service.passthrough_params
+            self.__bridge = Passthrough(dest_host, dest_port, params, on_close=on_close)
+            # asyncssh takes the channel from a (channel, session) tuple and awaits a coroutine session,
+            # it closes the channel if that raises ChannelOpenError
+            chan = self.__conn.create_tcp_channel(window=params.window, max_pktsize=params.max_pktsize)
+            return chan, self.__bridge.initialize()
+
+        self.__bridge = Bridge(orig_host, orig_port, dest_host, dest_port, self.__service.bridge_params,
+                               accepted_at=self.__times['accepted'], on_close=on_close)
         return self.__bridge.initialize()
 
 
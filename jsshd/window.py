@@ -0,0 +1,205 @@
+import time
+from collections import deque
+
+from asyncssh.constants import *
+from asyncssh.packet import Byte, UInt32
+
+
+# offset of the data length in the payloads which consume window
+_DATA_OFFSETS = {MSG_CHANNEL_DATA: 5, MSG_CHANNEL_EXTENDED_DATA: 9}
+
+# channel messages which have to stay behind queued data of their direction
+_ORDERED_MESSAGES = frozenset((MSG_CHANNEL_EOF, MSG_CHANNEL_CLOSE, MSG_CHANNEL_REQUEST,
+                               MSG_CHANNEL_SUCCESS, MSG_CHANNEL_FAILURE))
+
+_MAX_WINDOW = 0xffffffff
+
+
+def _uint32(payload, offset): return int.from_bytes(payload[offset:offset+4], 'big')
+
+
+
+class _Flow(object):
+    """
+    One direction of a channel: data sent by the sender leg is forwarded while the receiver's
+    window allows and queued otherwise, and the sender is granted window up to target itself.
+    """
+
+    def __init__(self, windows, leg, sender, receiver, peer_window):
+        self.__windows = windows
+        self.__leg = leg                    # 'src' or 'dst', the sender's leg whose rtt sizes target
+        self.__sender = sender
+        self.__receiver = receiver
+        self.__queue = deque()
+        self.recipient = None               # sender's channel id, for our window adjusts
+        self.peer_window = peer_window      # bytes the receiver still accepts
+        self.target = windows.clamp(peer_window)
+        self.granted = self.target          # bytes the sender may still send
+        self.queued = 0
+        self.__received = 0
+        self.__mark = (time.monotonic(), 0)
+        self.__limited = False
+        self.__abandoned = False
+
+    def receive(self, payload, n):
+        # the receiver sent CLOSE and discards data anyway
+        if self.__abandoned: return
+        self.granted -= n
+        self.__received += n
+        if self.granted < self.target // 8: self.__limited = True
+
+        if self.__queue or n > self.peer_window:
+            self.__queue.append((payload, n))
+            self.queued += n
+        else:
+            self.peer_window -= n
+            self.__receiver.send_payload(payload)
+        self.__grant()
+
+    def enqueue(self, payload):
+        """Queue a message behind the data, return False if nothing is queued and it may be sent now"""
+        if not self.__queue or self.__abandoned: return False
+        self.__queue.append((payload, 0))
+        return True
+
+    def adjust(self, n):
+        self.peer_window = min(self.peer_window + n, _MAX_WINDOW)
+        while self.__queue and self.__queue[0][1] <= self.peer_window:
+            payload, n = self.__queue.popleft()
+            self.queued -= n
+            self.peer_window -= n
+            self.__receiver.send_payload(payload)
+        self.__grant()
+
+    def abandon(self):
+        """
+        The receiver closed the channel: drop the queued data, which it would discard, and send the
+        queued messages, above all the sender's CLOSE, without waiting for window.
+        """
+        self.__abandoned = True
+        queue, self.__queue = self.__queue, deque()
+        self.queued = 0
+        for payload, n in queue:
+            if not n: self.__receiver.send_payload(payload)
+
+    def __grant(self):
+        if self.__abandoned: return
+        self.__tune()
+        grant = self.target - self.granted - self.queued
+        if grant < self.target // 2 or self.recipient is None: return
+        self.granted += grant
+        self.__sender.send_payload(Byte(MSG_CHANNEL_WINDOW_ADJUST) + self.recipient + UInt32(grant))
+
+    def __tune(self):
+        # once per rtt of the sender's leg: grow target to twice the measured bandwidth-delay
+        # product, and at least double it if the sender ran out of window
+        rtt = self.__windows.rtt.get(self.__leg, None)
+        now = time.monotonic()
+        if rtt is None or now - self.__mark[0] < rtt: return
+
+        rate = (self.__received - self.__mark[1]) / (now - self.__mark[0])
+        target = max(self.target, int(2 * rate * rtt))
+        if self.__limited: target = max(target, self.target * 2)
+        self.target = self.__windows.clamp(target)
+        self.__mark = (now, self.__received)
+        self.__limited = False
+
+
+
+class _Channel(object):
+    __slots__ = ('src_id', 'dst_id', 'up', 'down', 'closes')
+
+    def __init__(self, src_id, up, down):
+        self.src_id = src_id        # channel id of the user's client, recipient of dst -> src messages
+        self.dst_id = None          # channel id of the upstream, recipient of src -> dst messages
+        self.up = up                # src -> dst
+        self.down = down            # dst -> src
+        self.closes = 0
+
+
+
+class ChannelWindows(object):
+    """
+    Split flow control of a bridge's channels.
+
+    The window each leg's sender gets is set by the bridge from the measured rtt of that leg and
+    the throughput of the channel, between min_window and max_window, instead of being the window
+    of the far end. Data the far end has no window for yet waits in the bridge, bounded by the
+    window granted to the sender. rtt maps 'src' and 'dst' to the measured round trip times.
+    """
+
+    def __init__(self, src, dst, min_window, max_window):
+        self.__src = src
+        self.__dst = dst
+        self.__min_window = min_window
+        self.__max_window = min(max_window, _MAX_WINDOW)
+        self.__pending = {}         # src id -> _Channel waiting for its confirmation
+        self.__by_src_id = {}
+        self.__by_dst_id = {}
+        self.rtt = {}
+
+
+    def clamp(self, window): return max(self.__min_window, min(window, self.__max_window))
+
+
+    def open(self, payload):
+        """Forward a CHANNEL_OPEN of src with the window of the new down flow"""
+        offset = 5 + _uint32(payload, 1)
+        src_id, window = payload[offset:offset+4], _uint32(payload, offset + 4)
+
+        down = _Flow(self, 'dst', self.__dst, self.__src, window)
+        self.__pending[src_id] = _Channel(src_id, None, down)
+        self.__dst.send_payload(payload[:offset+4] + UInt32(down.target) + payload[offset+8:])
+
+
+    def confirm(self, payload):
+        """Forward a CHANNEL_OPEN_CONFIRMATION of dst with the window of the new up flow"""
+        channel = self.__pending.pop(payload[1:5], None)
+        if channel is None:
+            self.__src.send_payload(payload)
+            return
+
+        channel.dst_id = payload[5:9]
+        channel.up = _Flow(self, 'src', self.__src, self.__dst, _uint32(payload, 9))
+        channel.up.recipient = channel.src_id
+        channel.down.recipient = channel.dst_id
+        self.__by_src_id[channel.src_id] = channel
+        self.__by_dst_id[channel.dst_id] = channel
+        self.__src.send_payload(payload[:9] + UInt32(channel.up.target) + payload[13:])
+
+
+    def fail(self, payload): self.__pending.pop(payload[1:5], None)
+
+
+    def from_src(self, pkttype, payload):
+        """Relay a channel message of src, return False if it is not handled and has to be sent as usual"""
+        channel = self.__by_dst_id.get(payload[1:5], None)
+        return channel is not None and self.__relay(channel, channel.up, channel.down, pkttype, payload)
+
+
+    def from_dst(self, pkttype, payload):
+        channel = self.__by_src_id.get(payload[1:5], None)
+        return channel is not None and self.__relay(channel, channel.down, channel.up, pkttype, payload)
+
+
+    def __relay(self, channel, flow, reverse, pkttype, payload):
+        offset = _DATA_OFFSETS.get(pkttype, None)
+        if offset is not None:
+            flow.receive(payload, _uint32(payload, offset))
+            return True
+
+        if pkttype == MSG_CHANNEL_WINDOW_ADJUST:
+            reverse.adjust(_uint32(payload, 5))
+            return True
+
+        if pkttype != MSG_CHANNEL_CLOSE: return pkttype in _ORDERED_MESSAGES and flow.enqueue(payload)
+
+        # the sender of CLOSE takes no more data, the other side gets the CLOSE behind its data;
+        # with both closes seen both queues are empty and the channel is forgotten
+        reverse.abandon()
+        queued = flow.enqueue(payload)
+        channel.closes += 1
+        if channel.closes == 2:
+            self.__by_src_id.pop(channel.src_id, None)
+            self.__by_dst_id.pop(channel.dst_id, None)
+        return queued
@@ -0,0 +1,111 @@
+import pytest
+
+from jsshd.acl import AclPolicy, ModePolicy
+
+
+def _policy(tmp_path, text):
+    path = tmp_path / 'acl.yml'
+    path.write_text(text)
+    return AclPolicy(str(path))
+
+
+def test_longest_prefix_wins(tmp_path):
+    acl = _policy(tmp_path, """
+default: deny
+rules:
+  - {subjects: ['*'], allow: ['10.0.0.0/8'], deny: ['10.1.0.0/16']}
+  - {subjects: ['*'], allow: ['10.1.2.0/24']}
+""")
+    assert acl.check('alice', '10.2.0.1', 22)
+    assert not acl.check('alice', '10.1.0.1', 22)
+    assert acl.check('alice', '10.1.2.3', 22)
+    assert not acl.check('alice', '11.0.0.1', 22)
+
+
+def test_prefix_inside_a_byte(tmp_path):
+    acl = _policy(tmp_path, """
+rules:
+  - {subjects: ['*'], allow: ['192.168.4.0/22']}
+""")
+    assert acl.check('alice', '192.168.7.255', 22)
+    assert not acl.check('alice', '192.168.8.0', 22)
+    assert not acl.check('alice', '192.168.3.255', 22)
+
+
+def test_deny_wins_a_tie(tmp_path):
+    acl = _policy(tmp_path, """
+default: allow
+rules:
+  - {subjects: ['*'], allow: ['10.0.0.0/8', '*.example.com']}
+  - {subjects: ['*'], deny: ['10.0.0.0/8', '*.example.com']}
+""")
+    assert not acl.check('alice', '10.0.0.1', 22)
+    assert not acl.check('alice', 'db.example.com', 22)
+
+
+def test_wildcard_does_not_match_the_domain(tmp_path):
+    acl = _policy(tmp_path, """
+rules:
+  - {subjects: ['*'], allow: ['*.example.com']}
+""")
+    assert acl.check('alice', 'db.example.com', 22)
+    assert acl.check('alice', 'a.db.EXAMPLE.com.', 22)
+    assert not acl.check('alice', 'example.com', 22)
+    assert not acl.check('alice', 'example.org', 22)
+
+
+def test_exact_host_beats_wildcard(tmp_path):
+    acl = _policy(tmp_path, """
+rules:
+  - {subjects: ['*'], allow: ['*.example.com'], deny: ['db.example.com']}
+""")
+    assert acl.check('alice', 'web.example.com', 22)
+    assert not acl.check('alice', 'db.example.com', 22)
+
+
+def test_ports(tmp_path):
+    acl = _policy(tmp_path, """
+rules:
+  - {subjects: ['*'], allow: ['10.0.0.0/8'], ports: [22, 2222]}
+""")
+    assert acl.check('alice', '10.0.0.1', 2222)
+    assert not acl.check('alice', '10.0.0.1', 80)
+
+
+def test_user_rules_before_groups_before_everyone(tmp_path):
+    acl = _policy(tmp_path, """
+groups:
+  ops: [alice, bob]
+rules:
+  - {subjects: [alice], deny: ['10.1.0.0/16']}
+  - {subjects: ['@ops'], allow: ['10.0.0.0/8']}
+  - {subjects: ['*'], deny: ['10.0.0.0/8']}
+""")
+    assert not acl.check('alice', '10.1.0.1', 22)
+    assert acl.check('alice', '10.2.0.1', 22)
+    assert acl.check('bob', '10.1.0.1', 22)
+    assert not acl.check('carol', '10.2.0.1', 22)
+
+
+def test_literals_only_match_networks(tmp_path):
+    acl = _policy(tmp_path, """
+rules:
+  - {subjects: ['*'], allow: ['::1/128', '*.1']}
+""")
+    assert acl.check('alice', '::1', 22)
+    assert not acl.check('alice', '127.0.0.1', 22)
+
+
+def test_invalid_default(tmp_path):
+    with pytest.raises(ValueError):
+        _policy(tmp_path, 'default: maybe\n')
+
+
+def test_mode_policy():
+    modes = ModePolicy('bridge', ['10.1.0.0/16'], ['10.0.0.0/8', '10.1.0.0/16', '*.fast.example.com'])
+    assert modes.passthrough('10.2.0.1', 22)
+    assert not modes.passthrough('10.1.0.1', 22)
+    assert modes.passthrough('a.fast.example.com', 22)
+    assert not modes.passthrough('192.168.0.1', 22)
+    with pytest.raises(ValueError):
+        ModePolicy('relay')
@@ -0,0 +1,78 @@
+from jsshd import admission
+from jsshd.admission import TokenBucket, AdmissionControl, _RateLimiter
+
+
+def test_bucket_refill():
+    bucket = TokenBucket(2, 0.0)
+    assert bucket.take(1, 2, 0.0)
+    assert bucket.take(1, 2, 0.0)
+    assert not bucket.take(1, 2, 0.0)
+    assert not bucket.take(1, 2, 0.5)
+    assert bucket.take(1, 2, 1.0)
+    # refill stops at burst
+    assert bucket.take(1, 2, 100.0)
+    assert bucket.take(1, 2, 100.0)
+    assert not bucket.take(1, 2, 100.0)
+
+
+def test_disabled_limiter_keeps_no_buckets():
+    limiter = _RateLimiter()
+    assert all(limiter.take('alice', 0.0) for _ in range(100))
+    assert not limiter._RateLimiter__buckets
+
+
+def test_prune_drops_only_full_buckets(monkeypatch):
+    monkeypatch.setattr(admission, '_PRUNE_SIZE', 3)
+    limiter = _RateLimiter()
+    limiter.rate, limiter.burst = 1, 2
+
+    for key in 'abc': assert limiter.take(key, 0.0)
+    assert limiter.take('c', 1.5) and limiter.take('c', 1.5)
+
+    # a and b have refilled at 1.5, c is empty and survives
+    assert limiter.take('d', 1.5)
+    assert sorted(limiter._RateLimiter__buckets) == ['c', 'd']
+    assert not limiter.take('c', 1.5)
+
+
+def test_admit_and_release(monkeypatch):
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: 0.0)
+    control = AdmissionControl()
+    control.configure(max_bridges=3, max_per_user=2)
+
+    assert control.admit('alice', '10.0.0.1') is None
+    assert control.admit('alice', '10.0.0.1') is None
+    assert control.admit('alice', '10.0.0.1') == 'max_per_user'
+    assert control.admit('bob', '10.0.0.2') is None
+    assert control.admit('carol', '10.0.0.3') == 'max_bridges'
+
+    control.release('alice')
+    assert control.admit('carol', '10.0.0.3') is None
+
+
+def test_admit_rates(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: now[0])
+    control = AdmissionControl()
+    control.configure(user_rate=1, user_burst=1, addr_rate=1, addr_burst=2)
+
+    assert control.admit('alice', '10.0.0.1') is None
+    assert control.admit('alice', '10.0.0.1') == 'user_rate'
+    assert control.admit('bob', '10.0.0.1') is None
+    assert control.admit('carol', '10.0.0.1') == 'address_rate'
+
+    now[0] = 1.0
+    assert control.admit('alice', '10.0.0.1') is None
+
+
+def test_rejected_address_keeps_the_users_token(monkeypatch):
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: 0.0)
+    control = AdmissionControl()
+    control.configure(user_rate=1, user_burst=1, addr_rate=1, addr_burst=1)
+
+    assert control.admit('alice', '10.0.0.1') is None
+    assert control.admit('bob', '10.0.0.1') == 'address_rate'
+    assert control.admit('bob', '10.0.0.2') is None
+    # and a rejected user keeps the address' token
+    assert control.admit('bob', '10.0.0.3') == 'user_rate'
+    assert control.admit('carol', '10.0.0.3') is None
@@ -0,0 +1,279 @@
+import os
+import json
+import asyncio
+
+import asyncssh
+import pytest
+
+from jsshd.acl import ModePolicy
+from jsshd.admission import AdmissionControl
+from jsshd.bridge import BridgeParams
+from jsshd.fake.server import FakeSSHServerConnection
+from jsshd.pool import UpstreamPool
+from jsshd.recorder import SessionRecorder
+from jsshd.user import UserEntity
+
+
+class _Service(object):
+    """The parts of sshd.Service a bridged user needs"""
+
+    def __init__(self, bridge_params):
+        self.keystore = None
+        self.acl = None
+        self.admission = AdmissionControl()
+        self.modes = ModePolicy('bridge')
+        self.bridge_params = bridge_params
+        self.users = []
+
+    def keepalive(self, conn): return None
+
+    def on_user_connection_made(self, user): self.users.append(user)
+
+    def on_user_auth_completed(self, user): pass
+
+    def on_user_connection_lost(self, user): self.users.remove(user)
+
+
+class _Upstream(asyncssh.SSHServer):
+    def __init__(self, conns): self.__conns = conns
+
+    def connection_made(self, conn): self.__conns.append(conn)
+
+    def begin_auth(self, username): return True
+
+    def public_key_auth_supported(self): return True
+
+    def validate_public_key(self, username, key): return True
+
+    def connection_requested(self, dest_host, dest_port, orig_host, orig_port): return True
+
+
+async def _echo_process(process):
+    process.stdout.write(await process.stdin.read())
+    process.exit(0)
+
+
+async def _echo(reader, writer):
+    while True:
+        data = await reader.read(65536)
+        if not data: break
+        writer.write(data)
+        await writer.drain()
+    writer.write_eof()
+    writer.close()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture(scope='module')
+def key_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('keys') / 'key')
+    asyncssh.generate_private_key('ecdsa-sha2-nistp256').write_private_key(path)
+    return path
+
+
+class _Env(object):
+    """Echo server, upstream SSH server and jsshd of a test"""
+
+    def __init__(self, key_path, service):
+        self.key_path = key_path
+        self.service = service
+        self.upstream_conns = []
+        self.options = dict(username='alice', client_keys=[key_path], known_hosts=None, agent_path=None)
+
+    async def start(self):
+        self.echo = await asyncio.start_server(_echo, '127.0.0.1', 0)
+        self.upstream = await asyncssh.create_server(lambda: _Upstream(self.upstream_conns), '127.0.0.1', 0,
+                                                     server_host_keys=[self.key_path], process_factory=_echo_process)
+        self.sshd = await asyncssh.create_server(lambda: UserEntity(self.service), '127.0.0.1', 0,
+                                                 server_host_keys=[self.key_path])
+        self.port = self.echo.sockets[0].getsockname()[1]
+
+    def close(self):
+        for server in (self.sshd, self.upstream, self.echo): server.close()
+
+    async def connect(self):
+        """Return the user's (jump connection, connection to the upstream through the bridge)"""
+        outer = await asyncssh.connect('127.0.0.1', self.sshd.sockets[0].getsockname()[1], **self.options)
+        try:
+            inner = await asyncssh.connect('127.0.0.1', self.upstream.sockets[0].getsockname()[1],
+                                           tunnel=outer, **self.options)
+        except Exception:
+            outer.close()
+            raise
+        return outer, inner
+
+
+def bridged(loop, key_path, test, upstream_options=(), **params):
+    """Run test(env) against a jsshd bridging with params, connecting upstream with upstream_options"""
+    bridge_params = BridgeParams({'server_host_keys': [key_path]},
+                                 dict({'client_keys': [key_path], 'known_hosts': None, 'agent_path': None},
+                                      **dict(upstream_options)), **params)
+    env = _Env(key_path, _Service(bridge_params))
+
+    async def main():
+        await env.start()
+        try:
+            await test(env)
+        finally:
+            env.close()
+
+    loop.run_until_complete(asyncio.wait_for(main(), 20))
+
+
+async def echoed(inner, port, data):
+    reader, writer = await inner.open_connection('127.0.0.1', port)
+    writer.write(data)
+    writer.write_eof()
+    result = await reader.read()
+    writer.close()
+    return result
+
+
+def test_relay(loop, key_path):
+    async def test(env):
+        outer, inner = await env.connect()
+        async with outer, inner:
+            assert await echoed(inner, env.port, b'hello') == b'hello'
+            data = bytes(range(256)) * 4096
+            assert await echoed(inner, env.port, data) == data
+
+    bridged(loop, key_path, test)
+
+
+def test_cached_keys_serve_every_upstream_connection(loop, key_path):
+    async def test(env):
+        for _ in range(2):
+            outer, inner = await env.connect()
+            async with outer, inner:
+                assert await echoed(inner, env.port, b'hello') == b'hello'
+        assert len(env.upstream_conns) == 2
+
+    bridged(loop, key_path, test)
+
+
+async def _wait(condition, timeout=2):
+    for _ in range(int(timeout / 0.01)):
+        if condition(): return
+        await asyncio.sleep(0.01)
+    assert condition()
+
+
+def test_pooled_upstream_survives_the_users_disconnect(loop, key_path):
+    pool = UpstreamPool(4, 2, 60)
+
+    async def test(env):
+        for _ in range(2):
+            outer, inner = await env.connect()
+            async with outer:
+                async with inner:
+                    assert await echoed(inner, env.port, b'hello') == b'hello'
+                await _wait(lambda: len(pool) == 1)
+
+        assert len(env.upstream_conns) == 1 and pool.hits == 1
+        assert env.upstream_conns[0]._transport is not None
+
+    bridged(loop, key_path, test, pool=pool)
+
+
+def test_adaptive_windows_measure_src_after_auth(loop, key_path, monkeypatch):
+    # whether the user was authenticated when each rtt probe went out on the src leg
+    probes = []
+    make_global_request = asyncssh.connection.SSHConnection._make_global_request
+
+    def probe(conn, *args, **kwargs):
+        if isinstance(conn, FakeSSHServerConnection): probes.append(conn._auth_complete)
+        return make_global_request(conn, *args, **kwargs)
+
+    monkeypatch.setattr(asyncssh.connection.SSHConnection, '_make_global_request', probe)
+
+    async def test(env):
+        outer, inner = await env.connect()
+        async with outer, inner:
+            data = bytes(range(256)) * 4096
+            assert await echoed(inner, env.port, data) == data
+
+            windows = env.service.users[0].bridge._Bridge__windows
+            await _wait(lambda: set(windows.rtt) == {'src', 'dst'})
+            assert probes == [True]
+
+    bridged(loop, key_path, test, windows=(64 * 1024, 4 * 1024 * 1024))
+
+
+def test_recording_keeps_only_the_session_channel(loop, key_path, tmp_path):
+    recorder = SessionRecorder(str(tmp_path))
+
+    async def test(env):
+        outer, inner = await env.connect()
+        async with outer, inner:
+            assert await echoed(inner, env.port, b'forwarded') == b'forwarded'
+            process = await inner.create_process()
+            process.stdin.write('typed')
+            process.stdin.write_eof()
+            assert await process.stdout.read() == 'typed'
+            await process.wait()
+            assert await echoed(inner, env.port, b'forwarded') == b'forwarded'
+
+        await _wait(lambda: not env.service.users)
+        await recorder.close()
+
+    bridged(loop, key_path, test, recorder=recorder)
+
+    path, = tmp_path.iterdir()
+    with open(str(path)) as f:
+        header = json.loads(f.readline())
+        events = [json.loads(line) for line in f]
+    assert header['user'] == 'alice'
+    assert ''.join(data for _, kind, data in events if kind == 'i') == 'typed'
+    assert ''.join(data for _, kind, data in events if kind == 'o') == 'typed'
+
+
+def test_pause_and_resume_cross_the_bridge(loop, key_path):
+    async def test(env):
+        outer, inner = await env.connect()
+        async with outer, inner:
+            bridge = env.service.users[0].bridge
+            src, dst = bridge.source, bridge.destination
+
+            # a leg that cannot write stops reading on the other one
+            dst.pause_writing()
+            assert src.read_paused and not dst.read_paused
+            dst.resume_writing()
+            assert not src.read_paused
+
+            src.pause_writing()
+            assert dst.read_paused and not src.read_paused
+            src.resume_writing()
+            assert not dst.read_paused
+
+            assert await echoed(inner, env.port, b'hello') == b'hello'
+
+    bridged(loop, key_path, test, buffer_limits=(64 * 1024, 16 * 1024, 1024 * 1024))
+
+
+def test_upstream_compression_is_turned_off_and_on_again(loop, key_path):
+    async def test(env):
+        outer, inner = await env.connect()
+        async with outer, inner:
+            dst = env.service.users[0].bridge.destination
+            assert dst._compressor is not None
+
+            # random data does not compress, the upstream is rekeyed to none
+            data = os.urandom(2 * 1024 * 1024)
+            assert await echoed(inner, env.port, data) == data
+            await _wait(lambda: dst._compressor is None)
+
+            # and offered compression again after the retry interval, the next packet rekeys
+            await asyncio.sleep(0.3)
+            assert await echoed(inner, env.port, b'hello') == b'hello'
+            await _wait(lambda: dst._compressor is not None)
+
+    bridged(loop, key_path, test, upstream_options={'compression_algs': ['zlib@openssh.com']},
+            compression=(0.9, 0.2))
@@ -0,0 +1,46 @@
+from jsshd.fake import buffer
+from jsshd.fake.buffer import InputBuffer
+
+
+def test_partial_header_waits_for_the_rest():
+    packet = (12).to_bytes(4, 'big') + b'x' * 12
+    buf = InputBuffer()
+
+    buf.append(packet[:2])
+    assert len(buf) == 2 and buf.peek(4) == packet[:2]
+
+    buf.append(packet[2:7])
+    assert int.from_bytes(buf.peek(4), 'big') == 12
+    assert len(buf) < 16
+
+    buf.append(packet[7:] + b'next')
+    assert buf.read(16) == packet
+    assert buf.read(4) == b'next'
+    assert not buf
+
+
+def test_unconsumed_chunk_is_kept_until_more_data_arrives():
+    chunk = b'abcdef'
+    buf = InputBuffer()
+    buf.append(chunk)
+    assert buf._buf is chunk
+    assert buf.read(2) == b'ab'
+
+    buf.append(b'gh')
+    assert buf._buf.__class__ is bytearray
+    assert buf.peek(3, 1) == b'def'
+    assert buf.find(b'g') == 4 and buf.find(b'a') == -1
+    assert buf.read(6) == b'cdefgh'
+    assert len(buf) == 0 and buf._buf == b''
+
+
+def test_compaction(monkeypatch):
+    monkeypatch.setattr(buffer, '_COMPACT_THRESHOLD', 4)
+    buf = InputBuffer(b'0123')
+    buf.append(b'456789')
+
+    buf.consume(3)
+    assert buf._pos == 3
+    buf.consume(2)
+    assert buf._pos == 0 and bytes(buf._buf) == b'56789'
+    assert buf.read(5) == b'56789'
@@ -0,0 +1,67 @@
+from pyplus.collection import qdict
+
+from jsshd.fake.connection import FakeSSHConnection
+
+
+class _Loop(object):
+    def __init__(self): self.callbacks = []
+
+    def call_soon(self, callback, *args): self.callbacks.append((callback, args))
+
+    def run(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks: callback(*args)
+
+
+class _Transport(object):
+    def __init__(self): self.writes = []
+
+    def is_closing(self): return False
+
+    def write(self, data): self.writes.append([data])
+
+    def writelines(self, data): self.writes.append(list(data))
+
+    def get_write_buffer_size(self): return sum(len(d) for write in self.writes for d in write)
+
+
+class _Conn(FakeSSHConnection):
+    """The send path of FakeSSHConnection without an SSH session behind it"""
+
+    def __init__(self, max_buffer_size=None):
+        self._loop = _Loop()
+        self._transport = _Transport()
+        self._send_queue = []
+        self._write_stats = qdict(batches=0, packets=0, bytes=0, max_batch=0)
+        self._write_paused = False
+        self._max_buffer_size = max_buffer_size
+        self.closed = None
+
+    def _force_close(self, exc): self.closed = exc
+
+
+def test_packets_of_one_iteration_are_written_together():
+    conn = _Conn()
+    for data in (b'a', b'bc', b'def'): conn._send(data)
+    assert conn._transport.writes == [] and len(conn._loop.callbacks) == 1
+
+    conn._loop.run()
+    conn._send(b'g')
+    conn._loop.run()
+    assert conn._transport.writes == [[b'a', b'bc', b'def'], [b'g']]
+    stats = conn.write_stats
+    assert (stats.batches, stats.packets, stats.bytes, stats.max_batch) == (2, 4, 7, 3)
+
+
+
+def test_write_buffer_beyond_max_size_aborts_while_paused():
+    conn = _Conn(max_buffer_size=8)
+    conn._send(b'x' * 16)
+    conn._loop.run()
+    assert conn.closed is None
+
+    # the peer did not stop producing after pause_writing
+    conn._write_paused = True
+    conn._send(b'y')
+    conn._loop.run()
+    assert conn.closed is not None
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+
+import asyncssh
+
+from jsshd.keystore import KeyStore
+
+
+def _key():
+    key = asyncssh.generate_private_key('ecdsa-sha2-nistp256')
+    return key.convert_to_public(), key.export_public_key().decode('ascii').strip()
+
+
+def test_directory_keys_and_from_option(tmp_path):
+    alice, alice_line = _key()
+    bob, bob_line = _key()
+    (tmp_path / 'alice').write_text('# comment\nnot a key\nfrom="127.0.0.1" {}\n'.format(alice_line))
+    (tmp_path / 'bob').write_text(bob_line + '\n')
+    (tmp_path / '.hidden').write_text(alice_line + '\n')
+
+    store = KeyStore(directory=str(tmp_path)).load()
+    assert len(store) == 2
+    assert store.validate('alice', alice, '127.0.0.1') is not None
+    assert store.validate('alice', alice, '127.0.0.2') is None
+    assert store.validate('alice', bob, '127.0.0.1') is None
+    assert store.validate('bob', bob, '127.0.0.2') == {}
+
+
+def test_permitopen_is_kept(tmp_path):
+    key, line = _key()
+    (tmp_path / 'alice').write_text('permitopen="db:5432",permitopen="[::1]:*" {}\n'.format(line))
+
+    options = KeyStore(directory=str(tmp_path)).load().validate('alice', key, '127.0.0.1')
+    assert options['permitopen'] == {('db', 5432), ('::1', None)}
+
+
+def test_cert_authority_entries_are_skipped(tmp_path):
+    key, line = _key()
+    (tmp_path / 'alice').write_text('cert-authority {}\n'.format(line))
+    assert len(KeyStore(directory=str(tmp_path)).load()) == 0
+
+
+def test_changed_and_removed_sources(tmp_path):
+    alice, alice_line = _key()
+    other, other_line = _key()
+    path = tmp_path / 'alice'
+    path.write_text(alice_line + '\n')
+    store = KeyStore(directory=str(tmp_path)).load()
+
+    path.write_text(other_line + '\n')
+    st = os.stat(str(path))
+    os.utime(str(path), (st.st_atime, st.st_mtime + 10))
+    store.load()
+    assert store.validate('alice', alice, '127.0.0.1') is None
+    assert store.validate('alice', other, '127.0.0.1') is not None
+
+    path.unlink()
+    store.load()
+    assert len(store) == 0
+
+
+def test_database_keys(tmp_path):
+    alice, alice_line = _key()
+    path = str(tmp_path / 'keys.db')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE authorized_keys (username TEXT, key TEXT)')
+    db.execute('INSERT INTO authorized_keys VALUES (?, ?)', ('alice', alice_line))
+    db.execute('INSERT INTO authorized_keys VALUES (?, ?)', ('bob', 'garbage'))
+    db.commit()
+    db.close()
+
+    store = KeyStore(database=path).load()
+    assert len(store) == 1
+    assert store.validate('alice', alice, '127.0.0.1') == {}
+    assert store.validate('bob', alice, '127.0.0.1') is None
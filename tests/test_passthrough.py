@@ -0,0 +1,115 @@
+import socket
+import asyncio
+
+import asyncssh
+import pytest
+
+from jsshd.acl import ModePolicy
+from jsshd.admission import AdmissionControl
+from jsshd.passthrough import PassthroughParams
+from jsshd.user import UserEntity
+
+
+class _Service(object):
+    """The parts of sshd.Service a passthrough user needs"""
+
+    def __init__(self):
+        self.keystore = None
+        self.acl = None
+        self.admission = AdmissionControl()
+        self.modes = ModePolicy('passthrough')
+        self.passthrough_params = PassthroughParams(64 * 1024, 16 * 1024)
+        self.users = []
+
+    def keepalive(self, conn): return None
+
+    def on_user_connection_made(self, user): self.users.append(user)
+
+    def on_user_auth_completed(self, user): pass
+
+    def on_user_connection_lost(self, user): self.users.remove(user)
+
+
+async def _echo(reader, writer):
+    while True:
+        data = await reader.read(4096)
+        if not data: break
+        writer.write(data)
+    writer.write_eof()
+    await writer.drain()
+    writer.close()
+
+
+def _closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def _run(loop, test):
+    service = _Service()
+    key = asyncssh.generate_private_key('ecdsa-sha2-nistp256')
+
+    async def main():
+        echo = await asyncio.start_server(_echo, '127.0.0.1', 0)
+        sshd = await asyncssh.create_server(lambda: UserEntity(service), '127.0.0.1', 0, server_host_keys=[key])
+        try:
+            conn = await asyncssh.connect('127.0.0.1', sshd.sockets[0].getsockname()[1], username='alice',
+                                          client_keys=[key], known_hosts=None, agent_path=None)
+            async with conn:
+                await test(conn, echo.sockets[0].getsockname()[1], service)
+        finally:
+            sshd.close()
+            echo.close()
+            await sshd.wait_closed()
+            await echo.wait_closed()
+
+    loop.run_until_complete(asyncio.wait_for(main(), 10))
+
+
+def test_open_echo_and_eof(loop):
+    async def test(conn, port, service):
+        reader, writer = await conn.open_connection('127.0.0.1', port)
+        writer.write(b'hello')
+        assert await reader.readexactly(5) == b'hello'
+
+        writer.write(b'x' * 200000)
+        writer.write_eof()
+        assert await reader.read() == b'x' * 200000
+        assert reader.at_eof()
+        writer.close()
+
+        # the passthrough is the user's bridge and closes with the channel
+        passthrough = service.users[0].bridge
+        assert passthrough.channel is not None
+        for _ in range(100):
+            if passthrough.transport is None: break
+            await asyncio.sleep(0.01)
+        assert passthrough.transport is None
+
+    _run(loop, test)
+
+
+def test_destination_connect_failure(loop):
+    async def test(conn, port, service):
+        with pytest.raises(asyncssh.ChannelOpenError) as e:
+            await conn.open_connection('127.0.0.1', _closed_port())
+        assert e.value.code == asyncssh.OPEN_CONNECT_FAILED
+
+        # the user's connection survives and the admission slot is released
+        await asyncio.sleep(0.05)
+        assert service.users and service.users[0].connection._transport is not None
+        assert service.admission.admit('alice', '127.0.0.1') is None
+
+    _run(loop, test)
@@ -0,0 +1,90 @@
+import os
+import json
+import asyncio
+
+import pytest
+from asyncssh.constants import MSG_CHANNEL_DATA
+
+from jsshd import metrics
+from jsshd.recorder import SessionRecorder
+
+
+def _data(data):
+    return bytes((MSG_CHANNEL_DATA,)) + (0).to_bytes(4, 'big') + len(data).to_bytes(4, 'big') + data
+
+
+def _read(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def test_flush_writes_header_and_events(loop, tmp_path):
+    recorder = SessionRecorder(str(tmp_path))
+    recording = recorder.open(1, user='alice')
+    recording.record('i', MSG_CHANNEL_DATA, _data(b'ls\r'))
+    recording.record('o', MSG_CHANNEL_DATA, _data('é'.encode('utf-8')[:1]))
+    recording.record('o', MSG_CHANNEL_DATA, _data('é'.encode('utf-8')[1:]))
+    assert recorder.backlog == 5
+
+    loop.run_until_complete(recorder.flush())
+    assert recorder.backlog == 0
+    header, *events = _read(recording.path)
+    assert header['version'] == 2 and header['user'] == 'alice'
+    # a character split across packets is decoded once it is complete
+    assert [(kind, data) for _, kind, data in events] == [('i', 'ls\r'), ('o', ''), ('o', 'é')]
+
+    recording.close()
+    recording.record('i', MSG_CHANNEL_DATA, _data(b'exit'))
+    loop.run_until_complete(recorder.close())
+    assert len(_read(recording.path)) == 4
+
+
+def test_backlog_beyond_max_is_dropped(loop, tmp_path):
+    recorder = SessionRecorder(str(tmp_path), max_backlog=10)
+    recording = recorder.open(1)
+    dropped = metrics.recording_dropped.value
+
+    recording.record('i', MSG_CHANNEL_DATA, _data(b'12345678'))
+    recording.record('i', MSG_CHANNEL_DATA, _data(b'abc'))
+    recording.record('i', MSG_CHANNEL_DATA, _data(b'90'))
+    assert recorder.backlog == 10
+    assert metrics.recording_dropped.value == dropped + 3
+
+    loop.run_until_complete(recorder.close())
+    assert [data for _, _, data in _read(recording.path)[1:]] == ['12345678', '90']
+
+
+def test_failed_recording_is_closed(loop, tmp_path):
+    directory = tmp_path / 'recordings'
+    recorder = SessionRecorder(str(directory))
+    recording = recorder.open(1)
+    recording.record('i', MSG_CHANNEL_DATA, _data(b'ls'))
+    os.rmdir(str(directory))
+
+    loop.run_until_complete(recorder.flush())
+    assert recording.closed and recorder.backlog == 0
+    recording.record('i', MSG_CHANNEL_DATA, _data(b'ls'))
+    assert recorder.backlog == 0
+
+    loop.run_until_complete(recorder.close())
+    assert not directory.exists()
+
+
+def test_recording_stays_in_its_directory(loop, tmp_path):
+    recorder = SessionRecorder(str(tmp_path))
+    with pytest.raises(ValueError):
+        recorder.open('../../etc/passwd')
+
+    # client-chosen values only go into the header
+    recording = recorder.open(7, user='../../alice', host='../host:22')
+    assert os.path.dirname(recording.path) == os.path.realpath(str(tmp_path))
+    loop.run_until_complete(recorder.close())
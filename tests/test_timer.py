@@ -0,0 +1,141 @@
+from jsshd.timer import TimerWheel, Keepalive
+
+
+class _Handle(object):
+    def __init__(self): self.cancelled = False
+
+    def cancel(self): self.cancelled = True
+
+
+class _Loop(object):
+    """Runs the wheel's single call_at timer by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.pending = None
+
+    def time(self): return self.now
+
+    def call_at(self, when, callback):
+        self.pending = (when, callback, _Handle())
+        return self.pending[2]
+
+    def run_until(self, t):
+        while self.pending is not None and self.pending[0] <= t:
+            when, callback, handle = self.pending
+            self.pending = None
+            if handle.cancelled: continue
+            self.now = when
+            callback()
+        self.now = t
+
+
+def _wheel(slots=8):
+    loop = _Loop()
+    return loop, TimerWheel(tick=1.0, slots=slots, loop=loop)
+
+
+def test_timer_fires_on_its_tick():
+    loop, wheel = _wheel()
+    fired = []
+    wheel.call_later(2.5, fired.append, 'a')
+    loop.run_until(2.9)
+    assert fired == []
+    loop.run_until(3.0)
+    assert fired == ['a']
+    assert len(wheel) == 0
+    # the loop timer stops one idle tick later
+    loop.run_until(4.0)
+    assert loop.pending is None
+
+
+def test_timers_beyond_the_wheel_wait_their_rounds():
+    loop, wheel = _wheel(slots=8)
+    fired = []
+    for delay in (3, 8, 11, 19):
+        wheel.call_later(delay, lambda d=delay: fired.append((d, loop.time())))
+    loop.run_until(30)
+    assert fired == [(3, 3.0), (8, 8.0), (11, 11.0), (19, 19.0)]
+
+
+def test_cancelled_timer_does_not_fire():
+    loop, wheel = _wheel()
+    fired = []
+    timer = wheel.call_later(2, fired.append, 'a')
+    wheel.call_later(2, fired.append, 'b')
+    timer.cancel()
+    loop.run_until(5)
+    assert fired == ['b']
+    assert len(wheel) == 0
+
+
+def test_callback_may_schedule_and_failures_are_contained():
+    loop, wheel = _wheel()
+    fired = []
+
+    def again():
+        fired.append(loop.time())
+        if len(fired) < 3: wheel.call_later(1, again)
+
+    wheel.call_later(1, lambda: 1 / 0)
+    wheel.call_later(1, again)
+    loop.run_until(10)
+    assert fired == [1.0, 2.0, 3.0]
+
+
+def test_close_drops_every_timer():
+    loop, wheel = _wheel()
+    fired = []
+    wheel.call_later(1, fired.append, 'a')
+    wheel.close()
+    loop.run_until(5)
+    assert fired == [] and len(wheel) == 0
+
+
+class _Conn(object):
+    """What Keepalive uses of a connection, probes are counted instead of sent"""
+
+    def __init__(self):
+        self._transport = object()
+        self._recv_seq = 0
+        self._peer_addr, self._peer_port = '127.0.0.1', 22
+        self.read_paused = False
+        self.probes = 0
+        self.closed = None
+
+    def create_task(self, coro):
+        coro.close()
+        self.probes += 1
+
+    def _force_close(self, exc):
+        self._transport = None
+        self.closed = exc
+
+
+def test_keepalive_aborts_a_silent_connection():
+    loop, wheel = _wheel()
+    conn = _Conn()
+    Keepalive(wheel, conn, 1, 3)
+    loop.run_until(3.5)
+    assert conn.probes == 3 and conn.closed is None
+    # a packet answers the probes
+    conn._recv_seq += 1
+    loop.run_until(7.5)
+    assert conn.closed is None
+    loop.run_until(8.5)
+    assert conn.closed is not None and conn.probes == 6
+
+
+def test_keepalive_waits_while_reading_is_paused():
+    loop, wheel = _wheel()
+    conn = _Conn()
+    Keepalive(wheel, conn, 1, 3)
+    conn.read_paused = True
+    loop.run_until(20)
+    assert conn.probes == 0 and conn.closed is None
+
+    conn.read_paused = False
+    loop.run_until(23.5)
+    assert conn.probes == 3 and conn.closed is None
+    loop.run_until(24.5)
+    assert conn.closed is not None